@@ -0,0 +1,322 @@
+import asyncio
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import tok_regex
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def timed(f, *args):
+    t0 = time.perf_counter()
+    res = f(*args)
+    return res, time.perf_counter() - t0
+
+
+# Compile time of [a..z]{n,4n}, fully unrolled, against the repetition count n.
+# Construction is linear in the expanded pattern, so the per-copy time should
+# stay flat.
+def bench_compile_repetition(counts=(25, 50, 100, 200, 400, 800)):
+    print("compile [a-z]{n,4n}")
+    print(f"{'n':>6} {'states':>8} {'seconds':>10} {'us/copy':>9}")
+    for n in counts:
+        tree = tok_regex.parse(f"[{LETTERS}]{{{n},{4 * n}}}")
+        nfa, seconds = timed(tok_regex.parse_tree_to_nfa, tree, None)
+        print(f"{n:>6} {len(nfa):>8} {seconds:>10.4f} {1e6 * seconds / (4 * n):>9.1f}")
+
+
+# Compile time and table size of [a-z]{4,n} for large n. Bounds above
+# tok_regex.UNROLL_LIMIT become counters, so both should stay flat.
+def bench_compile_counted(bounds=(10, 100, 1000, 10000, 100000)):
+    print("compile [a-z]{4,n}")
+    print(f"{'n':>7} {'states':>8} {'bytes':>8} {'seconds':>10}")
+    for n in bounds:
+        tree = tok_regex.parse(f"[a-z]{{4,{n}}}")
+        nfa, seconds = timed(
+            lambda: tok_regex.compile_nfa(tok_regex.parse_tree_to_nfa(tree))
+        )
+        print(f"{n:>7} {nfa.n_states:>8} {nfa.nbytes():>8} {seconds:>10.4f}")
+
+
+# Parse time of a machine-generated alternation against its length. The parser
+# makes a single pass, so the time per character should stay flat.
+def bench_parse(sizes=(1000, 10000, 100000)):
+    print("parse (ab[c-e]{1,3}(x|<tokN>)|...)*")
+    print(f"{'chars':>7} {'seconds':>10} {'us/char':>8}")
+    for size in sizes:
+        branches = [f"ab[c-e]{{1,3}}(x|<tok{i}>)" for i in range(size // 22)]
+        pattern = f"({'|'.join(branches)})*"
+        _, seconds = timed(tok_regex.parse, pattern)
+        print(
+            f"{len(pattern):>7} {seconds:>10.4f} {1e6 * seconds / len(pattern):>8.2f}"
+        )
+
+
+# Time to find a phone number at the end of a log of growing size. The required
+# literals send search() straight to candidate positions, so the time should
+# grow with str.find, not with the automaton.
+def bench_search(lines=(1000, 10000, 100000)):
+    pattern = tok_regex.compile(r"\([0-9]{3}\) [0-9]{3}-[0-9]{4}")
+    print(f"search {pattern.pattern}")
+    print(f"{'chars':>9} {'seconds':>10}")
+    for n in lines:
+        log = "GET /index.html 200 (ok)\n" * n + "call (555) 123-4567\n"
+        match, seconds = timed(pattern.search, log)
+        assert match is not None
+        print(f"{len(log):>9} {seconds:>10.4f}")
+
+
+# 500 patterns against a batch of documents: one PatternSet scan per document
+# against one fullmatch per pattern per document.
+def bench_pattern_set(n_patterns=500, n_docs=2000):
+    rng = random.Random(0)
+    words = ["".join(rng.choices(LETTERS[:10], k=5)) for _ in range(n_patterns)]
+    patterns = [f"{w[:2]}[a-j]*{w[2:]}" for w in words]
+    docs = [
+        "".join(rng.choices(LETTERS[:10], k=rng.randint(5, 30))) for _ in range(n_docs)
+    ]
+    pattern_set = tok_regex.PatternSet(patterns)
+    compiled = [tok_regex.compile(p) for p in patterns]
+    print(f"{n_patterns} patterns x {n_docs} documents")
+    _, seconds = timed(lambda: [pattern_set.fullmatch(d) for d in docs])
+    print(f"{'PatternSet':>12} {seconds:>10.4f}")
+    _, seconds = timed(lambda: [[p.fullmatch(d) for p in compiled] for d in docs])
+    print(f"{'one by one':>12} {seconds:>10.4f}")
+
+
+# Concurrent requests spread over a few patterns, as an online service sees
+# them: AsyncMatcher batching against one executor call per request.
+def bench_async(n_patterns=5, n_requests=20000):
+    rng = random.Random(0)
+    patterns = [f"{LETTERS[i]}[a-j]*{LETTERS[i + 1]}" for i in range(n_patterns)]
+    requests = [
+        (rng.choice(patterns), "".join(rng.choices(LETTERS[:10], k=20)))
+        for _ in range(n_requests)
+    ]
+
+    async def batched():
+        matcher = tok_regex.AsyncMatcher()
+        return await asyncio.gather(*(matcher.match(p, s) for p, s in requests))
+
+    async def one_by_one():
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            *(
+                loop.run_in_executor(None, tok_regex.compile(p).fullmatch, s)
+                for p, s in requests
+            )
+        )
+
+    print(f"{n_requests} requests over {n_patterns} patterns")
+    _, seconds = timed(asyncio.run, batched())
+    print(f"{'AsyncMatcher':>12} {seconds:>10.4f}")
+    _, seconds = timed(asyncio.run, one_by_one())
+    print(f"{'one by one':>12} {seconds:>10.4f}")
+
+
+# Adversarial patterns. Each case gives the pattern for a size n, to check that
+# compiling is at most linear in n, and the input of length k to match against
+# the pattern at a fixed size, to check that matching is at most linear in k.
+# Cases without a fixed size have inputs that only match near the pattern's
+# size, so the pattern at size n is matched against the input of length n,
+# which may cost their product. Classic backtracking engines are exponential
+# on the first three.
+WIDE_CLASS = "".join(chr(c) + "-" + chr(c + 3) for c in range(0x100, 0x2100, 8))
+PATHOLOGICAL = {
+    "(a?){n}a{n}": (lambda n: f"(a?){{{n}}}a{{{n}}}", None, lambda k: "a" * k),
+    "((a*)*b)^n": (lambda n: "(a*)*b" * n, 1, lambda k: "a" * k),
+    "nested +": (lambda n: "(" * n + "a" + ")+" * n, 16, lambda k: "a" * k),
+    "[a-z]{n,100n}": (
+        lambda n: f"[a-z]{{{n},{100 * n}}}",
+        1000,
+        lambda k: (LETTERS * (k // 26 + 1))[:k],
+    ),
+    "wide classes": (
+        lambda n: f"[{WIDE_CLASS[: 4 * n]}]*",
+        1024,
+        lambda k: "".join(chr(0x100 + 8 * (i % 1024) + i % 4) for i in range(k)),
+    ),
+    "(w1|...|wn)*": (
+        lambda n: "(" + "|".join(f"w{i}x" for i in range(n)) + ")*",
+        1000,
+        lambda k: "".join(f"w{i % 1000}x" for i in range(k // 5)),
+    ),
+    "(.{0,n}){0,n}x": (lambda n: f"(.{{0,{n}}}){{0,{n}}}x", None, lambda k: "a" * k),
+}
+# Counted repetition is timed at sizes above UNROLL_LIMIT, so each series
+# builds it one way: with counters, as Pattern does there, and for these cases
+# also fully unrolled, where epsilon elimination is past its max_growth cap.
+# Unrolling [a-z]{n,100n} is what bench_compile_repetition times, and
+# (.{0,n}){0,n} unrolls into n * n copies by design.
+UNROLLED = {"(a?){n}a{n}"}
+COUNTED_SIZES = (64, 128, 256, 512)
+COMPILE_SIZES = (10, 20, 40, 80)
+INPUT_SIZES = (5000, 10000, 20000, 40000)
+# doubling the size may at most multiply cost by this, and costs below the
+# floors are too small to judge. Growing pattern and input together costs
+# their product, so there doubling may multiply cost by 2 * MAX_GROWTH.
+# Matching is judged on the work its budget counts rather than on its time,
+# which at these sizes varies too much from run to run.
+MAX_GROWTH = 3.0
+TIME_FLOOR = 0.005
+MEMORY_FLOOR = 1 << 20
+
+
+def measure(f, *args, repeat=3):
+    # best time of `repeat` runs, and the peak memory traced during one
+    seconds = min(timed(f, *args)[1] for _ in range(repeat))
+    tracemalloc.start()
+    f(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def work(f, *args):
+    # steps a budget counts during one run, symbols read plus automaton work,
+    # which unlike time are the same from run to run
+    budget = tok_regex.Budget()
+    f(*args, budget)
+    return budget.steps
+
+
+def superlinear(sizes, costs, floor, growth=MAX_GROWTH):
+    # sizes where cost grew faster than the size, beyond `growth` per doubling
+    return [
+        n2
+        for (n1, c1), (n2, c2) in zip(zip(sizes, costs), zip(sizes[1:], costs[1:]))
+        if c2 > floor and c2 > c1 * growth ** math.log2(n2 / n1)
+    ]
+
+
+def bench_pathological(cases=PATHOLOGICAL):
+    print(
+        f"{'case':>15} {'axis':>8} {'size':>7} {'seconds':>10} {'peak KB':>9}"
+        f" {'steps':>9}"
+    )
+    failures = []
+    for name, (pattern_for, match_size, input_for) in cases.items():
+        runs = []
+        if "{" in pattern_for(1):
+            builds = [("counters", 0)]
+            if name in UNROLLED:
+                builds.append(("unrolled", None))
+            for axis, limit in builds:
+                runs.append(
+                    (
+                        axis,
+                        COUNTED_SIZES,
+                        lambda p, limit=limit: tok_regex.build_automaton(
+                            tok_regex.parse(p), limit
+                        ),
+                        map(pattern_for, COUNTED_SIZES),
+                    )
+                )
+        else:
+            runs.append(
+                (
+                    "compile",
+                    COMPILE_SIZES,
+                    tok_regex.Pattern,
+                    map(pattern_for, COMPILE_SIZES),
+                )
+            )
+        if match_size is None:
+            nfas = {n: tok_regex.Pattern(pattern_for(n)).nfa for n in COUNTED_SIZES}
+            runs.append(
+                (
+                    "both",
+                    COUNTED_SIZES,
+                    lambda n, budget=None: tok_regex.LazyDFA(nfas[n]).match(
+                        input_for(n), budget
+                    ),
+                    COUNTED_SIZES,
+                )
+            )
+        else:
+            pattern = tok_regex.Pattern(pattern_for(match_size))
+            runs.append(
+                (
+                    "match",
+                    INPUT_SIZES,
+                    lambda s, budget=None: tok_regex.LazyDFA(pattern.nfa).match(
+                        s, budget
+                    ),
+                    map(input_for, INPUT_SIZES),
+                )
+            )
+        for axis, sizes, f, args in runs:
+            args = list(args)
+            seconds, peaks = zip(*(measure(f, arg) for arg in args))
+            costs = [("time", seconds, TIME_FLOOR), ("memory", peaks, MEMORY_FLOOR)]
+            steps = ["-"] * len(sizes)
+            if axis in ("match", "both"):
+                steps = [work(f, arg) for arg in args]
+                costs[0] = ("work", steps, 0)
+            for n, s, peak, step in zip(sizes, seconds, peaks, steps):
+                print(
+                    f"{name:>15} {axis:>8} {n:>7} {s:>10.4f} {peak // 1024:>9}"
+                    f" {step:>9}"
+                )
+            growth, shape = MAX_GROWTH, "linear"
+            if axis == "both":
+                growth, shape = 2 * MAX_GROWTH, "pattern size times input size"
+            for cost, values, floor in costs:
+                for n in superlinear(sizes, values, floor, growth):
+                    failures.append(
+                        f"{name}: {axis} {cost} grows faster than {shape} at {n}"
+                    )
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return not failures
+
+
+# Import time of tok_regex in a fresh interpreter, which every short-lived
+# worker pays. numpy and the other heavy modules load on first use, so the
+# import should stay under IMPORT_BUDGET seconds and leave numpy unloaded.
+IMPORT_BUDGET = 0.15
+
+
+def bench_import(repeat=5):
+    code = (
+        "import sys, time; t0 = time.perf_counter(); import tok_regex; "
+        "print(time.perf_counter() - t0, 'numpy' in sys.modules)"
+    )
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = [
+        subprocess.run(
+            [sys.executable, "-c", code], cwd=here, capture_output=True, check=True
+        ).stdout.split()
+        for _ in range(repeat)
+    ]
+    seconds = min(float(run[0]) for run in runs)
+    numpy_loaded = any(run[1] == b"True" for run in runs)
+    print(f"import tok_regex: {seconds:.4f}s (budget {IMPORT_BUDGET}s)")
+    if numpy_loaded:
+        print("FAIL importing tok_regex loads numpy")
+    if seconds > IMPORT_BUDGET:
+        print("FAIL importing tok_regex is over budget")
+    return seconds <= IMPORT_BUDGET and not numpy_loaded
+
+
+BENCHMARKS = {
+    "compile_repetition": bench_compile_repetition,
+    "compile_counted": bench_compile_counted,
+    "parse": bench_parse,
+    "search": bench_search,
+    "pattern_set": bench_pattern_set,
+    "async": bench_async,
+    "pathological": bench_pathological,
+    "import": bench_import,
+}
+
+
+if __name__ == "__main__":
+    # benchmarks with a pass/fail criterion return False when it fails
+    results = [BENCHMARKS[name]() for name in sys.argv[1:] or BENCHMARKS]
+    sys.exit(1 if False in results else 0)
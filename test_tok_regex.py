@@ -0,0 +1,95 @@
+import itertools
+import re
+
+import pytest
+
+import tok_regex
+
+# Differential tests: on the syntax tok_regex shares with re, every way of
+# matching must agree with re.fullmatch. "." is any symbol here, so re gets
+# DOTALL. The strings are short enough that re's backtracking stays cheap.
+
+PATTERNS = [
+    "abc",
+    "a|b|",
+    "a*",
+    "(a*)*b",
+    "(a|ab)(c|bcd)(d*)",
+    "[a-c]+c",
+    "[^b]*b?",
+    "a.c",
+    "\\.\\*",
+    "(ab|a)*b?",
+    "((a)|b)+",
+    "(a?){3}a{3}",
+    "a{2,}b{0,2}",
+    "(a|b){1,3}c",
+    "((ab?){2}b?){0,3}",
+    "(a*)+",
+    "(a|)*b",
+    "(.{0,34}){0,34}c",
+]
+# bounds above UNROLL_LIMIT, matched with counters, also get strings long
+# enough to reach them
+COUNTED = ["a{33,40}", "(ab|c){0,40}", "([ab]{2}){17,}"]
+
+SHORT = ["".join(s) for n in range(7) for s in itertools.product("abc", repeat=n)]
+LONG = [
+    "a" * n + tail for n in (32, 33, 34, 40, 41) for tail in ("", "b", "c", "ab")
+] + ["ab" * 17, "ab" * 18 + "c", "ab" * 40, "ab" * 41, "c" * 40, "a" * 35 + "c"]
+CASES = [(p, SHORT) for p in PATTERNS] + [(p, SHORT + LONG) for p in COUNTED]
+
+
+def expected(pattern, strings):
+    compiled = re.compile(pattern, re.DOTALL)
+    return [compiled.fullmatch(s) is not None for s in strings]
+
+
+@pytest.mark.parametrize("pattern, strings", CASES)
+def test_check(pattern, strings):
+    nfa = tok_regex.parse_tree_to_nfa(tok_regex.parse(pattern), None)
+    for s, match in zip(strings, expected(pattern, strings)):
+        assert tok_regex.check(nfa, s) == match, s
+
+
+@pytest.mark.parametrize("pattern, strings", CASES)
+def test_simulate(pattern, strings):
+    nfa = tok_regex.parse_tree_to_nfa(tok_regex.parse(pattern))
+    for s, match in zip(strings, expected(pattern, strings)):
+        assert tok_regex.simulate(nfa, s) == match, s
+
+
+@pytest.mark.parametrize("pattern, strings", CASES)
+def test_fullmatch(pattern, strings):
+    # whole match and group spans
+    compiled = tok_regex.compile(pattern)
+    reference = re.compile(pattern, re.DOTALL)
+    for s in strings:
+        result, match = compiled.fullmatch(s), reference.fullmatch(s)
+        assert (result is None) == (match is None), s
+        if match is not None:
+            spans = [match.span(i) for i in range(compiled.groups + 1)]
+            assert [result.span(i) for i in range(compiled.groups + 1)] == spans, s
+
+
+@pytest.mark.parametrize("pattern, strings", CASES)
+def test_match_many(pattern, strings):
+    result = tok_regex.compile(pattern).match_many(strings)
+    assert result.tolist() == expected(pattern, strings)
+
+
+@pytest.mark.parametrize("pattern, strings", CASES)
+def test_matcher(pattern, strings):
+    # a prefix is accepted iff re matches it, and once the matcher is dead no
+    # longer prefix matches either
+    compiled = re.compile(pattern, re.DOTALL)
+    matcher = tok_regex.compile(pattern).matcher()
+    for s in strings:
+        matcher.reset()
+        for i in range(len(s) + 1):
+            if matcher.is_dead():
+                assert not any(compiled.fullmatch(s[:j]) for j in range(i, len(s) + 1))
+                break
+            assert matcher.is_accepting() == bool(compiled.fullmatch(s[:i])), s[:i]
+            if i < len(s):
+                matcher.feed(s[i])
@@ -3,214 +3,770 @@
 # type Transitions = dict[char, set[State]]
 # type NFA = dict[State, Transitions]
 
-import random
-import string
+import importlib
+import itertools
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict, deque
 from copy import deepcopy
-import numpy as np
+from functools import cached_property, partial
 
 
-def randstr(N=5):
-    return "".join(
-        random.choice(string.ascii_uppercase + string.digits + string.ascii_lowercase)
-        for _ in range(N)
-    )
+class _LazyModule:
+    # Stands in for a module until its first use, then puts the real module in
+    # its place, so importing tok_regex doesn't pay for numpy or multiprocessing
+    # and later uses pay nothing extra.
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+np = _LazyModule("numpy", "np")
+argparse = _LazyModule("argparse", "argparse")
+asyncio = _LazyModule("asyncio", "asyncio")
+hashlib = _LazyModule("hashlib", "hashlib")
+json = _LazyModule("json", "json")
+futures = _LazyModule("concurrent.futures", "futures")
+shared_memory = _LazyModule("multiprocessing.shared_memory", "shared_memory")
 
 
 EXIT_STATE = "end"
 START_STATE = "start"
-ANY_CHAR = "ANY"
 
-open_to_close = {"[": "]", "(": ")", "{": "}", "<": ">"}
 
-SPECIAL_CHARS = set(r"|&.+*?^$()[]{}")
+class _AnyChar:
+    # sentinel label, so that no token (not even "ANY") can collide with it
+    def __repr__(self):
+        return "ANY_CHAR"
 
+    def __reduce__(self):
+        return "ANY_CHAR"
 
-def string_excludes(s: str, excludes):
-    assert set(excludes).issubset(SPECIAL_CHARS)
-    # assert SPECIAL_CHARS.issubset(set(excludes)), excludes
-    # Excludes are any subset of special chars
-    og_s = deepcopy(s)
-    s = list(s)
-    while s:
-        c = s.pop(0)
-        if c == "\\":
-            assert len(s) != 0, "group cannot end in an odd number of backslashes"
-            s.pop(0)
-            continue
-        for x in excludes:
-            if c == x:
-                assert False, f"{x} in {og_s}"
-    return True
 
+ANY_CHAR = _AnyChar()
+END_OF_INPUT = object()
 
 from typing import Union
 
+# Parsing. A lexer makes one pass over the pattern and a recursive-descent
+# parser turns its tokens into a tree of Nodes, so parse time is linear in the
+# length of the pattern. From loosest to tightest binding: &, |, concatenation,
+# then the repetition operators *, +, ? and {m,n}.
+
+
+class PatternError(ValueError):
+    def __init__(self, msg, pattern, pos):
+        super().__init__(f"{msg} at position {pos}")
+        self.msg = msg
+        self.pattern = pattern
+        self.pos = pos
+
+    def __reduce__(self):
+        # errors cross process boundaries, e.g. from an AsyncMatcher's pool
+        return type(self), (self.msg, self.pattern, self.pos)
+
+
+class Node:
+    # subclasses list their fields in __slots__; pos is where the node starts
+    __slots__ = ("pos",)
+
+    def __init__(self, *fields, pos=None):
+        assert len(fields) == len(self.__slots__)
+        for name, value in zip(self.__slots__, fields):
+            setattr(self, name, value)
+        self.pos = pos
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(repr(getattr(self, f)) for f in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
 
-def rename_state(nfa, state, new_state: Union[True, str] = True):
-    new_state = randstr() if new_state is True else new_state
+class Literal(Node):
+    # a run of plain characters, escapes already resolved
+    __slots__ = ("text",)
 
-    if state in nfa:
-        nfa[new_state] = deepcopy(nfa[state])
-        del nfa[state]
 
-    for cur_state, transitions in nfa.items():
-        for obs, dests in transitions.items():
-            assert isinstance(dests, set), dests
-            if state in dests:
-                nfa[cur_state][obs] = (dests - {state}).union({new_state})
+class Symbol(Node):
+    # one symbol: ANY_CHAR for ., a SymbolClass, or a whole token
+    __slots__ = ("label",)
 
-    return new_state
 
+class Concat(Node):
+    __slots__ = ("items",)
 
-def extract_bracket_group(s):
-    # s == a string that starts with a valid opening character: [, ), { and eventually closes,
-    # not necessarily by the end of the string
-    og_s = deepcopy(s)
-    open_ = s[0]
-    group = open_
-    close_ = open_to_close[open_]
-    s = list(s[1:])
-    counter = 1
 
-    while True:
-        assert (
-            len(s) != 0
-        ), f"extraction of bracketed group `{og_s}` failed, not enough closing brackets by end of string"
+class Alternation(Node):
+    __slots__ = ("items",)
 
-        c = s.pop(0)
-        group = group + c
+
+class Intersection(Node):
+    __slots__ = ("items",)
+
+
+class Repeat(Node):
+    # maximum is None when unbounded
+    __slots__ = ("item", "minimum", "maximum")
+
+
+class Group(Node):
+    # a parenthesized subpattern; groups are numbered from 1 by their "("
+    __slots__ = ("index", "item")
+
+
+REPEAT_OPERATORS = {"*": (0, None), "+": (1, None), "?": (0, 1)}
+
+
+def read_char(pattern, i):
+    # the possibly escaped character at i, and the index after it
+    if pattern[i] != "\\":
+        return pattern[i], i + 1
+    if i + 1 == len(pattern):
+        raise PatternError("pattern ends in an odd number of backslashes", pattern, i)
+    return pattern[i + 1], i + 2
+
+
+def read_token(pattern, i):
+    # <...> starting at i; <hello> is the whole token "hello" and <#50256> is
+    # token id 50256
+    depth = 0
+    j = i
+    while j < len(pattern):
+        c = pattern[j]
         if c == "\\":
-            assert (
-                len(s) != 0
-            ), "string in bracketed group must not end in odd number of backslashes"
-            s.pop(0)
+            j += 1
+        elif c == "<":
+            depth += 1
+        elif c == ">":
+            depth -= 1
+            if depth == 0:
+                if j == i + 1:
+                    raise PatternError("empty token <>", pattern, i)
+                return parse_token(pattern[i + 1 : j]), j + 1
+        j += 1
+    raise PatternError("missing >, unterminated token", pattern, i)
+
+
+def parse_token(s):
+    assert s != "", "empty token <>"
+    if s[0] == "#" and is_num(s[1:]):
+        return int(s[1:])
+    chars = []
+    i = 0
+    while i < len(s):
+        if s[i] == "\\":
+            assert i + 1 != len(s), "token cannot end in an odd number of backslashes"
+            i += 1
+        chars.append(s[i])
+        i += 1
+    return "".join(chars)
+
+
+def read_repeat(pattern, i):
+    # {m}, {m,} or {m,n} starting at i
+    end = pattern.find("}", i)
+    if end == -1:
+        raise PatternError("missing }, unterminated repetition", pattern, i)
+    minimum, comma, maximum = pattern[i + 1 : end].partition(",")
+    if not is_num(minimum) or not (is_num(maximum) or maximum == ""):
+        raise PatternError(f"bad repetition {pattern[i : end + 1]}", pattern, i)
+    minimum = int(minimum)
+    maximum = int(maximum) if maximum else None if comma else minimum
+    if maximum is not None and maximum < minimum:
+        raise PatternError("min repeat greater than max repeat", pattern, i)
+    return (minimum, maximum), end + 1
+
+
+def tokenize(pattern):
+    # yields (kind, value, position) for each token of the pattern
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        pos = i
+        if c in "()|&":
+            yield c, None, pos
+            i += 1
+        elif c in REPEAT_OPERATORS:
+            yield "repeat", REPEAT_OPERATORS[c], pos
+            i += 1
+        elif c == "{":
+            bounds, i = read_repeat(pattern, i)
+            yield "repeat", bounds, pos
+        elif c == ".":
+            yield "symbol", ANY_CHAR, pos
+            i += 1
+        elif c == "[":
+            symbols, i = read_class(pattern, i)
+            yield "symbol", symbols, pos
+        elif c == "<":
+            token, i = read_token(pattern, i)
+            yield "symbol", token, pos
+        elif c in "]}":
+            raise PatternError(f"unbalanced {c}", pattern, pos)
+        else:
+            c, i = read_char(pattern, i)
+            yield "char", c, pos
+    yield "end", None, len(pattern)
+
+
+# Parse trees are walked recursively (here and by every fragment builder), so
+# nesting is capped: groups plus repetition operators stacked on one atom may
+# go MAX_DEPTH deep, which keeps the deepest walk well within Python's default
+# recursion limit.
+
+MAX_DEPTH = 100
+
+
+class Parser:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.tokens = list(tokenize(pattern))
+        self.i = 0
+        self.groups = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.i]
+
+    def error(self, msg):
+        raise PatternError(msg, self.pattern, self.peek()[2])
+
+    def parse(self):
+        node = self.intersection()
+        if self.peek()[0] != "end":
+            self.error("unbalanced parenthesis")
+        return node
+
+    # Each level of grouping costs intersection -> alternation -> concat ->
+    # atom frames, so these loop rather than share a helper.
+
+    def intersection(self):
+        pos = self.peek()[2]
+        items = [self.alternation()]
+        while self.peek()[0] == "&":
+            self.i += 1
+            items.append(self.alternation())
+        return items[0] if len(items) == 1 else Intersection(items, pos=pos)
+
+    def alternation(self):
+        pos = self.peek()[2]
+        items = [self.concat()]
+        while self.peek()[0] == "|":
+            self.i += 1
+            items.append(self.concat())
+        return items[0] if len(items) == 1 else Alternation(items, pos=pos)
+
+    def concat(self):
+        # adjacent characters are collected into a single Literal
+        pos = self.peek()[2]
+        items = []
+        chars = []
+        while self.peek()[0] not in (")", "|", "&", "end"):
+            node = self.repeat(self.atom())
+            if type(node) is Literal:
+                if not chars:
+                    chars_pos = node.pos
+                chars.append(node.text)
+                continue
+            if chars:
+                items.append(Literal("".join(chars), pos=chars_pos))
+                chars = []
+            items.append(node)
+        if chars:
+            items.append(Literal("".join(chars), pos=chars_pos))
+        return items[0] if len(items) == 1 else Concat(items, pos=pos)
+
+    def repeat(self, node):
+        depth = self.depth
+        while self.peek()[0] == "repeat":
+            _, (minimum, maximum), pos = self.peek()
+            depth += 1
+            if depth > MAX_DEPTH:
+                raise PatternError("too deeply nested", self.pattern, pos)
+            self.i += 1
+            node = Repeat(node, minimum, maximum, pos=pos)
+        return node
+
+    def atom(self):
+        kind, value, pos = self.peek()
+        if kind == "repeat":
+            self.error("nothing to repeat")
+        self.i += 1
+        if kind == "char":
+            return Literal(value, pos=pos)
+        if kind == "symbol":
+            return Symbol(value, pos=pos)
+        if self.depth == MAX_DEPTH:
+            raise PatternError("too deeply nested", self.pattern, pos)
+        self.groups += 1
+        index = self.groups
+        self.depth += 1
+        node = self.intersection()
+        self.depth -= 1
+        if self.peek()[0] != ")":
+            raise PatternError("missing ), unterminated subpattern", self.pattern, pos)
+        self.i += 1
+        return Group(index, node, pos=pos)
+
+
+def parse(pattern):
+    return Parser(pattern).parse()
+
+
+# Character/token classes are a single transition labeled by a SymbolClass:
+# sorted, merged code point ranges for characters, a set of whole tokens, and
+# a negation flag. Membership is a binary search over the ranges.
+
+MAX_CODE_POINT = 0x10FFFF
+
+
+class SymbolClass:
+    __slots__ = ("ranges", "tokens", "negated", "_starts")
+
+    def __init__(self, ranges=(), tokens=(), negated=False):
+        merged = []
+        for lo, hi in sorted(ranges):
+            if merged and lo <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+            else:
+                merged.append((lo, hi))
+        self.ranges = tuple(merged)
+        self.tokens = frozenset(tokens)
+        self.negated = negated
+        self._starts = [lo for lo, _ in merged]
+
+    def __contains__(self, c):
+        if isinstance(c, str) and len(c) == 1:
+            i = bisect_right(self._starts, ord(c)) - 1
+            found = i >= 0 and ord(c) <= self.ranges[i][1]
+        else:
+            found = c in self.tokens
+        return found != self.negated
+
+    def __eq__(self, other):
+        if not isinstance(other, SymbolClass):
+            return NotImplemented
+        return (self.ranges, self.tokens, self.negated) == (
+            other.ranges,
+            other.tokens,
+            other.negated,
+        )
+
+    def __hash__(self):
+        return hash((self.ranges, self.tokens, self.negated))
+
+    def __repr__(self):
+        items = [
+            chr(lo) if lo == hi else f"{chr(lo)}-{chr(hi)}" for lo, hi in self.ranges
+        ]
+        items += [f"<#{t}>" if isinstance(t, int) else f"<{t}>" for t in self.tokens]
+        return f"[{'^' if self.negated else ''}{''.join(items)}]"
+
+
+def read_class(pattern, i):
+    # [...] starting at i: single characters, ranges like a-z, whole tokens
+    # like <hello> or <#17>, an optional leading ^ to negate, and \ escapes
+    start = i
+    i += 1
+    negated = pattern.startswith("^", i)
+    i += negated
+    ranges = []
+    tokens = set()
+    while i < len(pattern) and pattern[i] != "]":
+        if pattern[i] == "<":
+            token, i = read_token(pattern, i)
+            if isinstance(token, str) and len(token) == 1:
+                ranges.append((ord(token), ord(token)))
+            else:
+                tokens.add(token)
             continue
-        elif c == open_:
-            counter += 1
-        elif c == close_:
-            counter -= 1
-
-        if counter == 0:
-            return group
-
-
-# Converts string into a lisp-esque format
-
-
-def parse(s):
-    if s[0] == "(" and extract_bracket_group(s) == s:
-        return parse(s[1:-1])
-    s = list(s)
-    # last_group = ''
-    running_str = ""
-    #
-    subpatterns = []
-    while s:
-        c = s[0]
-        if c in "&|\{\}+*?^$()[]{}\\":
-            if c == "\\":
-                assert len(s) != 1, "groups can't end in odd number of backslashes"
-                running_str = running_str + s.pop(0) + s.pop(0)
-            elif c in "&|^$":
-                subpatterns.extend([running_str, s.pop(0)])
-                running_str = ""
-            elif c in "+*?":
-                if running_str == "":
-                    assert len(subpatterns) > 1
-                    if isinstance(subpatterns[-1], str):
-                        assert subpatterns[-1] not in "&|^$"
-                    subpatterns.append([s.pop(0), subpatterns.pop()])
-                else:
-                    subpatterns.extend([running_str[:-1], [s.pop(0), running_str[-1]]])
-                running_str = ""
-            elif c in r"([{":
-                bracket_group = extract_bracket_group("".join(s))
-                if c == "[":
-                    subpatterns.extend([running_str, ["[", bracket_group[1:-1]]])
-                elif c == "(":
-                    parsed = parse(bracket_group[1:-1])
-                    assert isinstance(parsed, list)
-                    subpatterns.extend([running_str, parsed])
-                elif c == "{":
-                    if "," not in bracket_group:
-                            assert is_num(bracket_group[1:-1])
-                            minimum = maximum = int(bracket_group[1:-1])
-                    else:
-                        minimum, maximum = bracket_group[1:-1].split(",")
-                        assert is_num(minimum)
-                        assert is_num(maximum) or maximum == ''
-                        maximum = int(maximum) if is_num(maximum) else None
-                        minimum = int(minimum)
-    
-                    if running_str == "":
-                        subpatterns.append(["{", minimum, maximum, subpatterns.pop()])
-                    else:
-                        subpatterns.extend(
-                            [
-                                running_str[:-1],
-                                ["{", minimum, maximum, running_str[-1]],
-                            ]
-                        )
-                s = s[len(bracket_group) :]
-                running_str = ""
+        lo, i = read_char(pattern, i)
+        if (
+            pattern.startswith("-", i)
+            and i + 1 < len(pattern)
+            and pattern[i + 1] != "]"
+        ):
+            hi, i = read_char(pattern, i + 1)
+            if lo > hi:
+                raise PatternError(f"range {lo}-{hi} is out of order", pattern, start)
+            ranges.append((ord(lo), ord(hi)))
         else:
-            running_str += s.pop(0)
-    subpatterns.append(running_str)
-    subpatterns = [p for p in subpatterns if p != ""]
-    while len(subpatterns) == 1 and isinstance(subpatterns[0], list):
-        subpatterns = subpatterns[0]
-
-    if "|" in subpatterns and "&" in subpatterns:
-        subpats = ["&", split_list(subpatterns, "&")]
-        for i, subpat in subpats[1]:
-            if "|" in subpat:
-                subpats[1][i] = ["|", split_list(subpat)]
-
-    elif "&" in subpatterns:
-        subpatterns = ["&", split_list(subpatterns, "&")]
-    elif "|" in subpatterns:
-        subpatterns = ["|", split_list(subpatterns, "|")]
-
-    return subpatterns
-
-
-def split_list(l, s):
-    res = [[]]
-    for pat in l:
-        if pat != s:
-            res[-1].append(pat)
+            ranges.append((ord(lo), ord(lo)))
+    if i == len(pattern):
+        raise PatternError("missing ], unterminated class", pattern, start)
+    return SymbolClass(ranges, tokens, negated), i + 1
+
+
+def parse_class(s):
+    return read_class(f"[{s}]", 0)[0]
+
+
+def _complement(ranges):
+    res = []
+    lo = 0
+    for start, end in ranges:
+        if start > lo:
+            res.append((lo, start - 1))
+        lo = end + 1
+    if lo <= MAX_CODE_POINT:
+        res.append((lo, MAX_CODE_POINT))
+    return res
+
+
+def _intersect_ranges(a, b):
+    res = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        lo, hi = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if lo <= hi:
+            res.append((lo, hi))
+        if a[i][1] < b[j][1]:
+            i += 1
         else:
-            res.append([])
-    res = [p for p in res if p != []]
-    for _ in range(4):
-        res = [p[0] if len(p) == 1 and isinstance(p[0], str) else p for p in res]
-        res = [p[0] if len(p) == 1 and isinstance(p[0], list) else p for p in res]
+            j += 1
     return res
 
 
-def make_or_nfa(parsed_groups):
-    nfas = [parse_tree_to_nfa(group) for group in parsed_groups]
-    if len(nfas) == 1:
-        return nfas[0]
-    group_starts = []
-    nfa = {}
-    for group_nfa in nfas:
-        new_start = rename_state(group_nfa, START_STATE)
-        new_exit = rename_state(group_nfa, EXIT_STATE)
-
-        # point to shared exit state
-        group_nfa[new_exit] = {"": {EXIT_STATE}}
-        group_starts.append(new_start)
-        nfa.update(group_nfa)
-    # add the shared start state
-    nfa[START_STATE] = {"": set(group_starts)}
+def intersect_classes(a, b):
+    if a.negated and b.negated:
+        return SymbolClass(a.ranges + b.ranges, a.tokens | b.tokens, True)
+    ranges = _intersect_ranges(
+        _complement(a.ranges) if a.negated else a.ranges,
+        _complement(b.ranges) if b.negated else b.ranges,
+    )
+    if a.negated:
+        tokens = b.tokens - a.tokens
+    elif b.negated:
+        tokens = a.tokens - b.tokens
+    else:
+        tokens = a.tokens & b.tokens
+    return SymbolClass(ranges, tokens)
+
+
+def intersect_labels(a, b):
+    # label of the product of two symbol edges, or None if no symbol takes both
+    if a is ANY_CHAR:
+        return b
+    if b is ANY_CHAR:
+        return a
+    if isinstance(a, SymbolClass) and isinstance(b, SymbolClass):
+        c = intersect_classes(a, b)
+        return c if c.ranges or c.tokens or c.negated else None
+    if isinstance(a, SymbolClass):
+        a, b = b, a
+    if isinstance(b, SymbolClass):
+        return a if a in b else None
+    return a if a == b else None
+
+
+# Budgets bound the cost of untrusted patterns and inputs. Matching takes
+# max_steps and a deadline on the time.monotonic() clock; the NFA builders
+# (and compile()) take max_states. Using up any of them raises BudgetExceeded.
+# Steps count work, not input: one per symbol consumed, plus one per NFA state
+# or counter configuration visited while working out a DFA state that isn't
+# cached yet (or per search state tried by check()). Each step is bounded
+# work, so reading the clock every CLOCK_INTERVAL steps, from inside the NFA
+# step that is doing the work, bounds how far a deadline can be overrun. No
+# budget at all costs one None check per step.
+
+CLOCK_INTERVAL = 1024
+
+
+class BudgetExceeded(RuntimeError):
+    def __init__(self, msg, limit):
+        super().__init__(msg)
+        self.msg = msg
+        self.limit = limit
+
+    def __reduce__(self):
+        return type(self), (self.msg, self.limit)
+
+
+class Budget:
+    __slots__ = ("max_steps", "deadline", "steps", "_clock_at")
+
+    def __init__(self, max_steps=None, deadline=None):
+        self.max_steps = max_steps
+        self.deadline = deadline
+        self.steps = 0
+        self._clock_at = 0
+
+    def spend(self, steps=1):
+        self.steps += steps
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise BudgetExceeded(
+                f"step budget of {self.max_steps} exceeded", self.max_steps
+            )
+        if self.deadline is not None and self.steps >= self._clock_at:
+            self._clock_at = self.steps + CLOCK_INTERVAL
+            if time.monotonic() > self.deadline:
+                raise BudgetExceeded("deadline passed", self.deadline)
+
+
+def new_budget(max_steps=None, deadline=None):
+    # None when there is nothing to enforce, so matchers can skip the checks
+    if max_steps is None and deadline is None:
+        return None
+    return Budget(max_steps, deadline)
+
+
+# NFAs are assembled from Thompson fragments: each builder adds its states to
+# a shared nfa and returns (start, exit), where exit is a dangling state that
+# the caller patches with an epsilon edge. Nothing is ever renamed or copied,
+# so construction is linear in the size of the expanded pattern.
+
+_state_ids = itertools.count()
+
+
+def new_state():
+    return f"q{next(_state_ids)}"
+
+
+# Counted repetition X{m,n} with bounds above unroll_limit is not unrolled:
+# the body is built once and wrapped in counter edges. ENTER pushes a counter
+# set to 0 and enters the body; when the body finishes, LOOP re-enters it with
+# the counter incremented (while fewer than n iterations are done) and EXIT
+# pops the counter and leaves (once at least m are done). Matchers keep the
+# counter values alongside each active state, see CountedNFA.
+
+UNROLL_LIMIT = 32
+ENTER, LOOP, EXIT = 0, 1, 2
+
+_counter_ids = itertools.count()
+
+
+class CounterOp:
+    __slots__ = ("counter", "op", "minimum", "maximum")
+
+    def __init__(self, counter, op, minimum, maximum):
+        self.counter = counter
+        self.op = op
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def _key(self):
+        return self.counter, self.op, self.minimum, self.maximum
+
+    def __eq__(self, other):
+        if not isinstance(other, CounterOp):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        op = ("ENTER", "LOOP", "EXIT")[self.op]
+        return f"CounterOp({self.counter}, {op}, {self.minimum}, {self.maximum})"
+
+
+class NFA(dict):
+    # an NFA under construction, with the options every fragment builder sees
+    def __init__(self, unroll_limit=UNROLL_LIMIT, max_states=None):
+        super().__init__()
+        self.unroll_limit = unroll_limit
+        self.max_states = max_states
+
+    def check_size(self):
+        if self.max_states is not None and len(self) > self.max_states:
+            raise BudgetExceeded(
+                f"NFA has more than {self.max_states} states", self.max_states
+            )
+
+
+def string_fragment(nfa, s):
+    start = current_state = new_state()
+    for c in s:
+        next_state = new_state()
+        nfa[current_state] = {c: {next_state}}
+        current_state = next_state
+    return start, current_state
+
+
+def or_fragment(nfa, parsed_groups):
+    start, exit_ = new_state(), new_state()
+    for group in parsed_groups:
+        group_start, group_exit = tree_fragment(nfa, group)
+        add_eps_transition(nfa, start, group_start)
+        add_eps_transition(nfa, group_exit, exit_)
+    return start, exit_
+
+
+def token_fragment(nfa, token):
+    start, exit_ = new_state(), new_state()
+    nfa[start] = {token: {exit_}}
+    return start, exit_
+
+
+def char_fragment(nfa, char_nfa: str):
+    start, exit_ = new_state(), new_state()
+    nfa[start] = {parse_class(char_nfa): {exit_}}
+    return start, exit_
+
+
+def concat_fragment(nfa, parsed_groups):
+    start = current_state = new_state()
+    for group in parsed_groups:
+        group_start, group_exit = tree_fragment(nfa, group)
+        add_eps_transition(nfa, current_state, group_start)
+        current_state = group_exit
+        # unrolled {m,n} copies are built here, one group at a time
+        nfa.check_size()
+    return start, current_state
+
+
+def star_fragment(nfa, parsed):
+    start, exit_ = new_state(), new_state()
+    inner_start, inner_exit = tree_fragment(nfa, parsed)
+    add_eps_transition(nfa, start, inner_start)
+    add_eps_transition(nfa, start, exit_)
+    add_eps_transition(nfa, inner_exit, inner_start)
+    add_eps_transition(nfa, inner_exit, exit_)
+    return start, exit_
+
+
+def optional_fragment(nfa, parsed):
+    start, exit_ = new_state(), new_state()
+    inner_start, inner_exit = tree_fragment(nfa, parsed)
+    add_eps_transition(nfa, start, inner_start)
+    add_eps_transition(nfa, start, exit_)
+    add_eps_transition(nfa, inner_exit, exit_)
+    return start, exit_
+
+
+def counter_fragment(nfa, minimum, maximum, antecedent):
+    start, exit_ = new_state(), new_state()
+    body_start, body_exit = tree_fragment(nfa, antecedent)
+    counter = next(_counter_ids)
+    nfa.setdefault(start, {})[CounterOp(counter, ENTER, minimum, maximum)] = {
+        body_start
+    }
+    nfa.setdefault(body_exit, {})[CounterOp(counter, LOOP, minimum, maximum)] = {
+        body_start
+    }
+    nfa[body_exit][CounterOp(counter, EXIT, minimum, maximum)] = {exit_}
+    if minimum == 0:
+        add_eps_transition(nfa, start, exit_)
+    return start, exit_
+
+
+def and_fragment(nfa, parsed_groups):
+    # A top-level & is matched as a lazy product (see IntersectionNFA); one
+    # nested inside a larger pattern is spelled out here over the state pairs
+    # reachable from the operands' starts. Operands are fully unrolled, since
+    # the product of two counter stacks can't be expressed as one.
+    operands = []
+    for group in parsed_groups:
+        operand = NFA(unroll_limit=None, max_states=nfa.max_states)
+        operands.append((operand, *tree_fragment(operand, group)))
+    product = operands[0]
+    for operand in operands[1:]:
+        product = product_fragment(product, operand)
+    nfa.update(product[0])
+    return product[1:]
+
+
+def product_fragment(a, b):
+    (a, a_start, a_exit), (b, b_start, b_exit) = a, b
+    product = NFA(unroll_limit=None, max_states=a.max_states)
+    names = {(a_start, b_start): new_state()}
+    queue = [(a_start, b_start)]
+    for p, q in queue:
+        product.check_size()
+        a_edges, b_edges = a.get(p, {}), b.get(q, {})
+        edges = [("", p_dest, q) for p_dest in a_edges.get("", ())]
+        edges += [("", p, q_dest) for q_dest in b_edges.get("", ())]
+        for a_obs, p_dests in a_edges.items():
+            for b_obs, q_dests in b_edges.items():
+                if a_obs == "" or b_obs == "":
+                    continue
+                obs = intersect_labels(a_obs, b_obs)
+                if obs is not None:
+                    edges += [(obs, d, e) for d in p_dests for e in q_dests]
+        for obs, *dest in edges:
+            dest = tuple(dest)
+            if dest not in names:
+                names[dest] = new_state()
+                queue.append(dest)
+            product.setdefault(names[p, q], {}).setdefault(obs, set()).add(names[dest])
+    exit_ = names.get((a_exit, b_exit)) or new_state()
+    return product, names[a_start, b_start], exit_
+
+
+def repeat_fragment(nfa, item, minimum, maximum):
+    if (minimum, maximum) == (0, None):
+        return star_fragment(nfa, item)
+    if (minimum, maximum) == (1, None):
+        start, exit_ = tree_fragment(nfa, item)
+        add_eps_transition(nfa, exit_, start)
+        return start, exit_
+    if (minimum, maximum) == (0, 1):
+        return optional_fragment(nfa, item)
+    bound = minimum if maximum is None else maximum
+    if nfa.unroll_limit is not None and bound > nfa.unroll_limit:
+        return counter_fragment(nfa, minimum, maximum, item)
+    items = [item] * minimum
+    if maximum is None:
+        items.append(Repeat(item, 0, None))
+    else:
+        items.extend([Repeat(item, 0, 1)] * (maximum - minimum))
+    return concat_fragment(nfa, items)
+
+
+def tree_fragment(nfa, parsed: Union[Node, str]):
+    if isinstance(parsed, str) or type(parsed) is Literal:
+        return string_fragment(nfa, getattr(parsed, "text", parsed))
+    elif type(parsed) is Symbol:
+        return token_fragment(nfa, parsed.label)
+    elif type(parsed) is Concat:
+        return concat_fragment(nfa, parsed.items)
+    elif type(parsed) is Alternation:
+        return or_fragment(nfa, parsed.items)
+    elif type(parsed) is Intersection:
+        return and_fragment(nfa, parsed.items)
+    elif type(parsed) is Repeat:
+        return repeat_fragment(nfa, parsed.item, parsed.minimum, parsed.maximum)
+    elif type(parsed) is Group:
+        return tree_fragment(nfa, parsed.item)
+    else:
+        assert False, f"not a parse tree node: {parsed!r}"
+
+
+def fragment_to_nfa(build, *args, unroll_limit=UNROLL_LIMIT, max_states=None):
+    nfa = NFA(unroll_limit, max_states)
+    start, exit_ = build(nfa, *args)
+    add_eps_transition(nfa, START_STATE, start)
+    add_eps_transition(nfa, exit_, EXIT_STATE)
+    nfa.check_size()
     return nfa
 
 
+def make_or_nfa(parsed_groups):
+    return fragment_to_nfa(or_fragment, parsed_groups)
+
+
 def make_char_nfa(char_nfa: str):
-    assert string_excludes(char_nfa, excludes=r"|?{}()+.[]")
+    return fragment_to_nfa(char_fragment, char_nfa)
 
-    return make_or_nfa(list(char_nfa))
+
+def make_string_nfa(s):
+    return fragment_to_nfa(string_fragment, s)
 
 
 DIGITS = "0123456789"
@@ -220,27 +776,6 @@ def is_num(s):
     return all([c in DIGITS for c in s]) and len(s) > 0
 
 
-def make_string_nfa(s):
-    s = list(s)
-    nfa = {}
-    current_state = START_STATE
-    while s:
-        next_state = randstr()
-        if s[0] == ".":
-            nfa[current_state] = {ANY_CHAR: {next_state}}
-            s = s[1:]
-        elif s[0] == "\\":
-            assert len(s) >= 2
-            nfa[current_state] = {s[1]: {next_state}}
-            s = s[2:]
-        else:
-            nfa[current_state] = {s[0]: {next_state}}
-            s = s[1:]
-        current_state = next_state
-    rename_state(nfa, current_state, EXIT_STATE)
-    return nfa
-
-
 def add_eps_transition(nfa, start, end):
     if start not in nfa:
         nfa[start] = {}
@@ -250,94 +785,38 @@ def add_eps_transition(nfa, start, end):
     return nfa
 
 
-def make_optional_nfa(p):
-    parse_tree_to_nfa(p)
-
-
-def parse_tree_to_nfa(parsed: Union[list, str]):
-    if isinstance(parsed, str):
-        return make_string_nfa(parsed)
-
-    if isinstance(parsed[0], str) and parsed[0] in r"*+?[{&|":
-        # First argument gives the root type; create a nfa for each case
-        assert isinstance(
-            parsed, list
-        ), f"parser error, the following string shouldn't start with the character it does: {parsed[0]}"
-        node_type = parsed[0]
-        node_args = parsed[1:]
-    
-        if node_type == "*":
-            assert len(node_args) == 1
-            nfa = parse_tree_to_nfa(node_args[0])
-            add_eps_transition(nfa, EXIT_STATE, START_STATE)
-            add_eps_transition(nfa, START_STATE, EXIT_STATE)
-            return nfa
-        elif node_type == "+":
-            assert len(node_args) == 1
-            return parse_tree_to_nfa([parse_tree_to_nfa(node_args[0]), ["*", node_args[0]]])
-        elif node_type == "?":
-            assert len(node_args) == 1
-            nfa = parse_tree_to_nfa(parsed[1])
-            add_eps_transition(nfa, START_STATE, EXIT_STATE)
-            return nfa
-        elif node_type == "[":
-            assert isinstance(node_args[0], str)
-            assert len(node_args) == 1
-            return make_char_nfa(node_args[0])
-        elif node_type == "{":
-            assert len(node_args) == 3, print(node_args)
-            minimum, maximum, antecedent = node_args[0], node_args[1], node_args[2]
-            if maximum is None:
-                return parse_tree_to_nfa(
-                    [[r"{", minimum, minimum, antecedent], ["*", antecedent]]
-                )
-            else:
-                subtree = []
-                for _ in range(minimum):
-                    subtree.append(antecedent)
-                for _ in range(maximum - minimum):
-                    subtree.append(["?", antecedent])
-                return parse_tree_to_nfa(subtree)
-        elif node_type == "&":
-            assert False, "& unimplemented, needs modifications to parse_tree_to_nfa"
-        elif node_type == "|":
-            assert len(node_args) == 1
-            return make_or_nfa(node_args[0])
-        else:
-            assert False, f'Previously-thought impossible case, "{node_type}"'
-    else:
-        nfa = {}
-        current_state = randstr()
-        add_eps_transition(nfa, START_STATE, current_state)
-        while parsed:
-            new_nfa = parse_tree_to_nfa(parsed.pop(0))
-            new_state = randstr()
-            rename_state(new_nfa, START_STATE, current_state)
-            rename_state(new_nfa, EXIT_STATE, new_state)
-            nfa.update(new_nfa)
-
-            current_state = new_state
-
-        rename_state(nfa, current_state, EXIT_STATE)
-
-        return nfa
+def parse_tree_to_nfa(
+    parsed: Union[Node, str], unroll_limit=UNROLL_LIMIT, max_states=None
+):
+    # unroll_limit=None expands every {m,n} in full, as check() requires;
+    # max_states raises BudgetExceeded for patterns that expand past it
+    return fragment_to_nfa(
+        tree_fragment, parsed, unroll_limit=unroll_limit, max_states=max_states
+    )
 
 
-def check(nfa, s):
+def check(nfa, s, max_steps=None, deadline=None):
+    assert not any(
+        isinstance(obs, CounterOp)
+        for transitions in nfa.values()
+        for obs in transitions
+    ), "check() needs a fully unrolled NFA, use parse_tree_to_nfa(..., unroll_limit=None)"
     pennies = [
         {
             "state": START_STATE,
             "string": "",
             "i": 0,
             "eps_seen_states": set(),
-            "transitions": [],
         }
     ]
+    budget = new_budget(max_steps, deadline)
     while pennies:
+        if budget is not None:
+            budget.spend()
         penny = pennies.pop()
         state = penny["state"]
 
-        next_char = s[penny["i"]] if penny["i"] < len(s) else False
+        next_char = s[penny["i"]] if penny["i"] < len(s) else END_OF_INPUT
 
         state_transitions = nfa.get(state, {})
         for next_state in nfa.get(state, {}).get("", []):
@@ -345,39 +824,2389 @@ def check(nfa, s):
                 new_penny = deepcopy(penny)
                 new_penny["eps_seen_states"].add(penny["state"])
                 new_penny["state"] = next_state
-                new_penny["transitions"].append((state, "", next_state))
                 pennies.append(new_penny)
 
-        if (
-            next_char in state_transitions
-            or ANY_CHAR in state_transitions
-            and next_char is not False
-        ):
-            attainable_states = state_transitions.get(next_char, set()).union(
-                state_transitions.get(ANY_CHAR, set())
-            )
+        if next_char is not END_OF_INPUT:
+            attainable_states = set()
+            for obs, dests in state_transitions.items():
+                if (
+                    obs == next_char
+                    or obs is ANY_CHAR
+                    or isinstance(obs, SymbolClass)
+                    and next_char in obs
+                ):
+                    attainable_states |= dests
             for next_state in attainable_states:
                 new_penny = deepcopy(penny)
                 new_penny["eps_seen_states"] = set()
                 new_penny["state"] = next_state
-                new_penny["string"] += next_char
+                new_penny["string"] = s[: penny["i"] + 1]
                 new_penny["i"] += 1
-                new_penny["transitions"].append((state, next_char, next_state))
                 pennies.append(new_penny)
 
-        if next_char == False and penny["state"] == EXIT_STATE:
+        if next_char is END_OF_INPUT and penny["state"] == EXIT_STATE:
             return True
     else:
         return False
 
-s = r'[ab]{3}'
-s = r"\([0123456789]{3}\) [0123456789]{3}-[0123456789]{4,}"
-nfa = parse_tree_to_nfa(parse(s))
+
+# Compiled NFAs: states are dense ints, every symbol mentioned in the pattern
+# gets a dense id (0 is reserved for all other symbols), and transitions live
+# in flat CSR arrays -- row i of (sym_ids, sym_dests) spans
+# sym_indptr[i]:sym_indptr[i + 1], with epsilon edges in their own CSR.
+# ANY_CHAR and SymbolClass edges are expanded into one edge per symbol id
+# they cover so that matchers never have to special-case them.
+
+OTHER_SYMBOL = 0
+
+
+class Alphabet:
+    # Maps input symbols to dense ids. Literal symbols are looked up in
+    # `symbols`; any other character falls in one of the code point intervals
+    # [boundaries[i], boundaries[i + 1]), which share the id interval_ids[i]
+    # with every character that belongs to exactly the same classes.
+    def __init__(self, symbols, boundaries, interval_ids):
+        self.symbols = symbols
+        self.boundaries = boundaries
+        self.interval_ids = interval_ids
+        self.n_symbols = int(interval_ids.max(initial=len(symbols))) + 1
+        self._bounds = boundaries.tolist()
+        self._ids = interval_ids.tolist()
+
+    def classify(self, c):
+        sym = self.symbols.get(c)
+        if sym is not None:
+            return sym
+        if self._bounds and isinstance(c, str) and len(c) == 1:
+            return self.interval_id(ord(c))
+        return OTHER_SYMBOL
+
+    def interval_id(self, code_point):
+        i = bisect_right(self._bounds, code_point) - 1
+        return self._ids[i] if i >= 0 else OTHER_SYMBOL
+
+    @cached_property
+    def symbol_list(self):
+        # symbol id -> symbol; ids shared by a range of characters map to a
+        # SymbolClass of those characters, and OTHER_SYMBOL to ANY_CHAR
+        symbol_list = [ANY_CHAR] + list(self.symbols)
+        ranges = [[] for _ in range(len(symbol_list), self.n_symbols)]
+        bounds = self._bounds + [MAX_CODE_POINT + 1]
+        for i, sym in enumerate(self._ids):
+            if sym != OTHER_SYMBOL:
+                ranges[sym - len(symbol_list)].append((bounds[i], bounds[i + 1] - 1))
+        return symbol_list + [SymbolClass(r) for r in ranges]
+
+    def arrays(self):
+        return {"boundaries": self.boundaries, "interval_ids": self.interval_ids}
+
+    def __getstate__(self):
+        return self.symbols, self.boundaries, self.interval_ids
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def build_alphabet(labels):
+    # Returns the alphabet for a set of transition labels, and for each
+    # SymbolClass among them the list of symbol ids it covers.
+    symbols = {}
+    classes = []
+    for label in labels:
+        if isinstance(label, SymbolClass):
+            classes.append(label)
+            items = label.tokens
+        elif label == "" or label is ANY_CHAR or isinstance(label, CounterOp):
+            continue
+        else:
+            items = (label,)
+        for item in items:
+            if item not in symbols:
+                symbols[item] = len(symbols) + 1
+
+    points = sorted({p for c in classes for lo, hi in c.ranges for p in (lo, hi + 1)})
+    default = tuple(c.negated for c in classes)
+    signature_ids = {default: OTHER_SYMBOL}
+    interval_ids = []
+    for p in points:
+        if p > MAX_CODE_POINT:
+            signature = default
+        else:
+            signature = tuple(chr(p) in c for c in classes)
+        if signature not in signature_ids:
+            signature_ids[signature] = len(symbols) + len(signature_ids)
+        interval_ids.append(signature_ids[signature])
+
+    class_ids = {
+        c: [sym for item, sym in symbols.items() if item in c]
+        + [sym for signature, sym in signature_ids.items() if signature[j]]
+        for j, c in enumerate(classes)
+    }
+    alphabet = Alphabet(
+        symbols,
+        np.array(points, dtype=np.int32),
+        np.array(interval_ids, dtype=np.int32),
+    )
+    return alphabet, class_ids
+
+
+def merge_alphabets(alphabets):
+    # Returns the alphabet that refines every one of `alphabets`, and for each
+    # of them an array mapping joint symbol ids to its own ids.
+    symbols = {}
+    for alphabet in alphabets:
+        for item in alphabet.symbols:
+            symbols.setdefault(item, len(symbols) + 1)
+    maps = [[OTHER_SYMBOL] + list(map(a.classify, symbols)) for a in alphabets]
+
+    points = sorted(set().union(*(a._bounds for a in alphabets)))
+    signature_ids = {(OTHER_SYMBOL,) * len(alphabets): OTHER_SYMBOL}
+    interval_ids = []
+    for p in points:
+        signature = tuple(a.interval_id(p) for a in alphabets)
+        if signature not in signature_ids:
+            signature_ids[signature] = len(symbols) + len(signature_ids)
+            for ids, sym in zip(maps, signature):
+                ids.append(sym)
+        interval_ids.append(signature_ids[signature])
+
+    alphabet = Alphabet(
+        symbols,
+        np.array(points, dtype=np.int32),
+        np.array(interval_ids, dtype=np.int32),
+    )
+    return alphabet, [np.array(ids, dtype=np.int32) for ids in maps]
+
+
+def _csr(n_rows, rows, *cols):
+    rows = np.asarray(rows, dtype=np.int32)
+    cols = [np.asarray(col, dtype=np.int32) for col in cols]
+    order = np.lexsort(tuple(reversed(cols)) + (rows,))
+    indptr = np.zeros(n_rows + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return (indptr, *[col[order] for col in cols])
+
+
+def _gather(indptr, states):
+    # indices of all CSR entries in the rows of `states`
+    starts = indptr[states]
+    counts = indptr[states + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(total)
+
+
+class CompiledNFA:
+    def __init__(
+        self,
+        alphabet,
+        start,
+        accepting,
+        sym_indptr,
+        sym_ids,
+        sym_dests,
+        eps_indptr,
+        eps_dests,
+    ):
+        self.alphabet = alphabet
+        self.symbols = alphabet.symbols
+        self.n_symbols = alphabet.n_symbols
+        self.n_states = len(accepting)
+        self.start = start
+        self.accepting = accepting
+        self.sym_indptr = sym_indptr
+        self.sym_ids = sym_ids
+        self.sym_dests = sym_dests
+        self.eps_indptr = eps_indptr
+        self.eps_dests = eps_dests
+
+    def classify(self, c):
+        return self.alphabet.classify(c)
+
+    def closure(self, states):
+        if not len(self.eps_dests):
+            return states
+        seen = np.zeros(self.n_states, dtype=bool)
+        seen[states] = True
+        frontier = states
+        while len(frontier):
+            next_states = self.eps_dests[_gather(self.eps_indptr, frontier)]
+            frontier = np.unique(next_states[~seen[next_states]])
+            seen[frontier] = True
+        return np.flatnonzero(seen).astype(np.int32)
+
+    def initial(self):
+        return self.closure(np.array([self.start], dtype=np.int32))
+
+    def step(self, states, sym, budget=None):
+        idx = _gather(self.sym_indptr, states)
+        next_states = np.unique(self.sym_dests[idx[self.sym_ids[idx] == sym]])
+        next_states = self.closure(next_states)
+        if budget is not None:
+            budget.spend(len(states) + len(next_states))
+        return next_states
+
+    def accepts(self, states):
+        return bool(self.accepting[states].any())
+
+    def edges(self):
+        return [(self.sym_indptr, self.sym_dests), (self.eps_indptr, self.eps_dests)]
+
+    @cached_property
+    def live(self):
+        # states from which an accepting state can still be reached
+        n = self.n_states
+        edges = self.edges()
+        rows = np.arange(n, dtype=np.int32)
+        srcs = np.concatenate([np.repeat(rows, np.diff(indptr)) for indptr, _ in edges])
+        dests = np.concatenate([dests for _, dests in edges])
+        indptr, preds = _csr(n, dests, srcs)
+        indptr, preds = indptr.tolist(), preds.tolist()
+        live = self.accepting.copy()
+        stack = np.flatnonzero(live).tolist()
+        while stack:
+            state = stack.pop()
+            for pred in preds[indptr[state] : indptr[state + 1]]:
+                if not live[pred]:
+                    live[pred] = True
+                    stack.append(pred)
+        return live
+
+    def prune(self, states):
+        return states[self.live[states]]
+
+    def next_symbols(self, states):
+        # ids of the symbols that lead from states to a live state
+        idx = _gather(self.sym_indptr, states)
+        return np.unique(self.sym_ids[idx[self.live[self.sym_dests[idx]]]])
+
+    ARRAYS = (
+        "accepting",
+        "sym_indptr",
+        "sym_ids",
+        "sym_dests",
+        "eps_indptr",
+        "eps_dests",
+    )
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays().values())
+
+    # everything but the arrays, for rebuilding the NFA around shared copies
+    def shared_meta(self):
+        return self.alphabet, self.start
+
+    @classmethod
+    def from_shared(cls, meta, arrays):
+        return cls(*meta, **arrays)
+
+
+def compile_nfa(nfa):
+    # number states in BFS order from START_STATE; unreachable states are dropped
+    state_ids = {START_STATE: 0}
+    labels = {}
+    queue = [START_STATE]
+    edges = []
+    for state in queue:
+        for obs, dests in nfa.get(state, {}).items():
+            labels[obs] = None
+            for dest in dests:
+                if dest not in state_ids:
+                    state_ids[dest] = len(state_ids)
+                    queue.append(dest)
+                edges.append((state_ids[state], obs, state_ids[dest]))
+
+    n_states = len(state_ids)
+    alphabet, class_ids = build_alphabet(labels)
+    sym_edges = set()
+    eps_edges = set()
+    ctr_edges = set()
+    counters = {}
+    for src, obs, dest in edges:
+        if obs == "":
+            eps_edges.add((src, dest))
+        elif isinstance(obs, CounterOp):
+            counter = counters.setdefault(obs.counter, (len(counters), obs))[0]
+            ctr_edges.add((src, obs.op, counter, dest))
+        elif obs is ANY_CHAR:
+            sym_edges.update((src, sym, dest) for sym in range(alphabet.n_symbols))
+        elif isinstance(obs, SymbolClass):
+            sym_edges.update((src, sym, dest) for sym in class_ids[obs])
+        else:
+            sym_edges.add((src, alphabet.symbols[obs], dest))
+    sym_edges = list(zip(*sym_edges)) or [(), (), ()]
+    eps_edges = list(zip(*eps_edges)) or [(), ()]
+
+    accepting = np.zeros(n_states, dtype=bool)
+    if EXIT_STATE in state_ids:
+        accepting[state_ids[EXIT_STATE]] = True
+
+    args = [
+        alphabet,
+        0,
+        accepting,
+        *_csr(n_states, *sym_edges),
+        *_csr(n_states, *eps_edges),
+    ]
+    if not ctr_edges:
+        return CompiledNFA(*args)
+    ops = [op for _, op in sorted(counters.values(), key=lambda c: c[0])]
+    return CountedNFA(
+        *args,
+        *_csr(n_states, *zip(*ctr_edges)),
+        np.array([op.minimum for op in ops], dtype=np.int32),
+        np.array(
+            [-1 if op.maximum is None else op.maximum for op in ops], dtype=np.int32
+        ),
+    )
+
+
+class CountedNFA(CompiledNFA):
+    # A compiled NFA with counter edges. Its "states" as seen by matchers are
+    # configurations (state, counter values), interned as virtual state ids
+    # on first use, so counted repetition costs memory only for the
+    # configurations a match actually visits.
+    def __init__(
+        self,
+        alphabet,
+        start,
+        accepting,
+        sym_indptr,
+        sym_ids,
+        sym_dests,
+        eps_indptr,
+        eps_dests,
+        ctr_indptr,
+        ctr_ops,
+        ctr_counters,
+        ctr_dests,
+        counter_min,
+        counter_max,
+    ):
+        super().__init__(
+            alphabet,
+            start,
+            accepting,
+            sym_indptr,
+            sym_ids,
+            sym_dests,
+            eps_indptr,
+            eps_dests,
+        )
+        self.ctr_indptr = ctr_indptr
+        self.ctr_ops = ctr_ops
+        self.ctr_counters = ctr_counters
+        self.ctr_dests = ctr_dests
+        self.counter_min = counter_min
+        self.counter_max = counter_max
+        self._rows = {
+            name: getattr(self, name).tolist()
+            for name in CompiledNFA.ARRAYS + CountedNFA.ARRAYS[6:]
+        }
+        self._configs = []
+        self._config_ids = {}
+        self._lock = threading.Lock()
+        # counts at or above this have met every counter's minimum
+        self._count_floor = max(self._rows["counter_min"], default=0) - 1
+
+    ARRAYS = CompiledNFA.ARRAYS + (
+        "ctr_indptr",
+        "ctr_ops",
+        "ctr_counters",
+        "ctr_dests",
+        "counter_min",
+        "counter_max",
+    )
+
+    def edges(self):
+        return super().edges() + [(self.ctr_indptr, self.ctr_dests)]
+
+    def _intern(self, configs):
+        ids = []
+        for config in configs:
+            config_id = self._config_ids.get(config)
+            if config_id is None:
+                with self._lock:
+                    config_id = self._config_ids.setdefault(config, len(self._configs))
+                    if config_id == len(self._configs):
+                        self._configs.append(config)
+            ids.append(config_id)
+        return np.array(sorted(ids), dtype=np.int32)
+
+    def _close(self, configs, budget=None):
+        rows = self._rows
+        eps_indptr, eps_dests = rows["eps_indptr"], rows["eps_dests"]
+        ctr_indptr, ctr_dests = rows["ctr_indptr"], rows["ctr_dests"]
+        ctr_ops, ctr_counters = rows["ctr_ops"], rows["ctr_counters"]
+        counter_min, counter_max = rows["counter_min"], rows["counter_max"]
+        closure = set(configs)
+        stack = list(configs)
+        while stack:
+            if budget is not None:
+                budget.spend()
+            state, counts = stack.pop()
+            next_configs = [
+                (next_state, counts)
+                for next_state in eps_dests[eps_indptr[state] : eps_indptr[state + 1]]
+            ]
+            for j in range(ctr_indptr[state], ctr_indptr[state + 1]):
+                op, counter, dest = ctr_ops[j], ctr_counters[j], ctr_dests[j]
+                lo, hi = counter_min[counter], counter_max[counter]
+                if op == ENTER:
+                    next_configs.append((dest, counts + (0,)))
+                elif op == LOOP and (hi < 0 or counts[-1] + 1 < hi):
+                    # unbounded counters saturate at the minimum
+                    done = counts[-1] + 1 if hi >= 0 else min(counts[-1] + 1, lo)
+                    next_configs.append((dest, counts[:-1] + (done,)))
+                elif op == EXIT and counts[-1] + 1 >= lo:
+                    next_configs.append((dest, counts[:-1]))
+            for config in next_configs:
+                if config not in closure:
+                    closure.add(config)
+                    stack.append(config)
+        return self._undominated(closure)
+
+    def _undominated(self, configs):
+        # A configuration is redundant next to one in the same state whose
+        # counts are equal or, once both have met the minimum, lower: the
+        # lower counts can take every counter edge the higher ones can, so
+        # they accept at least as much. Without this, nested counters such as
+        # (.{0,n}){0,n} carry every pair of counts and each symbol costs n * n.
+        floor = self._count_floor
+        kept = []
+        groups = {}
+        for state, counts in configs:
+            if not counts or max(counts) < floor:
+                kept.append((state, counts))
+                continue
+            # counts below the minimum must match exactly
+            key = state, tuple(c if c < floor else -1 for c in counts)
+            groups.setdefault(key, []).append(counts)
+        for (state, _), group in groups.items():
+            # a dominating configuration has the smaller sum, so it comes first
+            group.sort(key=sum)
+            minimal = []
+            for counts in group:
+                if not any(all(a <= b for a, b in zip(low, counts)) for low in minimal):
+                    minimal.append(counts)
+            kept.extend((state, counts) for counts in minimal)
+        return kept
+
+    def closure(self, states):
+        return self._intern(self._close([self._configs[i] for i in states.tolist()]))
+
+    def initial(self):
+        return self._intern(self._close([(self.start, ())]))
+
+    def step(self, states, sym, budget=None):
+        rows = self._rows
+        sym_indptr, sym_ids, sym_dests = (
+            rows["sym_indptr"],
+            rows["sym_ids"],
+            rows["sym_dests"],
+        )
+        if budget is not None:
+            budget.spend(len(states))
+        next_configs = set()
+        for i in states.tolist():
+            state, counts = self._configs[i]
+            for j in range(sym_indptr[state], sym_indptr[state + 1]):
+                if sym_ids[j] == sym:
+                    next_configs.add((sym_dests[j], counts))
+        return self._intern(self._close(next_configs, budget))
+
+    def base_states(self, states):
+        return np.array([self._configs[i][0] for i in states.tolist()], dtype=np.int32)
+
+    def accepts(self, states):
+        return bool(self.accepting[self.base_states(states)].any())
+
+    def prune(self, states):
+        return states[self.live[self.base_states(states)]]
+
+    def next_symbols(self, states):
+        return super().next_symbols(self.base_states(states))
+
+
+# Epsilon elimination: the closure of every reachable state is computed once
+# and folded into its symbol transitions, delta'(q, a) = delta(E(q), a), and q
+# accepts if anything in E(q) does. The result has no epsilon edges, so
+# matchers never walk closures at match time, and states that were only
+# reachable through epsilon edges disappear.
+
+
+def eliminate_epsilons(nfa, max_growth=4):
+    # counter edges need the epsilon structure around them, so NFAs with
+    # counted repetition keep their epsilon edges
+    if not len(nfa.eps_dests) or isinstance(nfa, CountedNFA):
+        return nfa
+    # Folding closures can square the edge count, e.g. for (w1|...|wn)* where
+    # every branch end reaches every branch start. Past max_growth times the
+    # original edges, the NFA keeps its epsilons instead.
+    max_edges = max_growth * (len(nfa.sym_dests) + len(nfa.eps_dests))
+    sym_indptr = nfa.sym_indptr.tolist()
+    sym_ids = nfa.sym_ids.tolist()
+    sym_dests = nfa.sym_dests.tolist()
+    eps_indptr = nfa.eps_indptr.tolist()
+    eps_dests = nfa.eps_dests.tolist()
+    accepting = nfa.accepting.tolist()
+
+    new_ids = {nfa.start: 0}
+    queue = [nfa.start]
+    new_accepting = []
+    srcs, syms, dests = [], [], []
+    for state in queue:
+        closure = {state}
+        stack = [state]
+        while stack:
+            current = stack.pop()
+            for next_state in eps_dests[eps_indptr[current] : eps_indptr[current + 1]]:
+                if next_state not in closure:
+                    closure.add(next_state)
+                    stack.append(next_state)
+        edges = set()
+        for current in closure:
+            lo, hi = sym_indptr[current], sym_indptr[current + 1]
+            edges.update(zip(sym_ids[lo:hi], sym_dests[lo:hi]))
+        if len(srcs) + len(edges) > max_edges:
+            return nfa
+        for sym, dest in edges:
+            if dest not in new_ids:
+                new_ids[dest] = len(new_ids)
+                queue.append(dest)
+            srcs.append(new_ids[state])
+            syms.append(sym)
+            dests.append(new_ids[dest])
+        new_accepting.append(any(accepting[current] for current in closure))
+
+    n_states = len(new_ids)
+    return CompiledNFA(
+        nfa.alphabet,
+        0,
+        np.array(new_accepting, dtype=bool),
+        *_csr(n_states, srcs, syms, dests),
+        *_csr(n_states, [], []),
+    )
+
+
+# Intersection. A pattern whose top level is A & B is matched on the lazy
+# product of the operands: a state set is the union of the operands' sets, with
+# operand i's state q stored as q * k + i, and every step advances each operand
+# separately on the joint alphabet. Product states only come into existence as
+# the LazyDFA or a Matcher reaches them, so the |A| x |B| product is never built.
+#
+# Liveness is the exception: each operand being able to accept doesn't mean
+# they can accept the same input (after "ab", a(b|c)d & a(b|c)e has none). A
+# set is live iff some tuple of single operand states, one from each part, can
+# reach a tuple of accepting states. prune() searches the product graph of such
+# tuples from the ones in hand and memoizes each tuple's answer, so the search
+# only ever covers the part of the product that pruned sets lead to.
+
+
+class IntersectionNFA:
+    def __init__(self, nfas):
+        self.nfas = nfas
+        self.alphabet, self.maps = merge_alphabets([nfa.alphabet for nfa in nfas])
+        self.symbols = self.alphabet.symbols
+        self.n_symbols = self.alphabet.n_symbols
+        self._maps = [ids.tolist() for ids in self.maps]
+        self._live = {}
+
+    def classify(self, c):
+        return self.alphabet.classify(c)
+
+    def split(self, states):
+        k = len(self.nfas)
+        return [states[states % k == i] // k for i in range(k)]
+
+    def join(self, parts):
+        # the product is dead as soon as any operand is
+        if not all(len(part) for part in parts):
+            return np.zeros(0, dtype=np.int32)
+        k = len(parts)
+        return np.sort(np.concatenate([part * k + i for i, part in enumerate(parts)]))
+
+    def initial(self):
+        return self.join([nfa.initial() for nfa in self.nfas])
+
+    def step(self, states, sym, budget=None):
+        return self.join(
+            [
+                nfa.step(part, ids[sym], budget)
+                for nfa, ids, part in zip(self.nfas, self._maps, self.split(states))
+            ]
+        )
+
+    def accepts(self, states):
+        parts = self.split(states)
+        return all(nfa.accepts(part) for nfa, part in zip(self.nfas, parts))
+
+    def _successors(self, states):
+        # tuples reachable from a tuple of single states in one step
+        singles = [np.array([q], dtype=np.int32) for q in states]
+        allowed = np.ones(self.n_symbols, dtype=bool)
+        for nfa, ids, single in zip(self.nfas, self.maps, singles):
+            allowed &= np.isin(ids, nfa.next_symbols(single))
+        for sym in np.flatnonzero(allowed).tolist():
+            parts = [
+                nfa.prune(nfa.step(single, ids[sym])).tolist()
+                for nfa, ids, single in zip(self.nfas, self._maps, singles)
+            ]
+            yield from itertools.product(*parts)
+
+    def _explore(self, roots):
+        # settles the liveness of roots and of every tuple reachable from them
+        live = self._live
+        order = [states for states in dict.fromkeys(roots) if states not in live]
+        seen = set(order)
+        preds = {}
+        found = []
+        for states in order:
+            singles = [np.array([q], dtype=np.int32) for q in states]
+            if all(nfa.accepts(s) for nfa, s in zip(self.nfas, singles)):
+                found.append(states)
+                continue
+            for succ in self._successors(states):
+                if live.get(succ):
+                    found.append(states)
+                    break
+                if succ in live:
+                    continue
+                preds.setdefault(succ, []).append(states)
+                if succ not in seen:
+                    seen.add(succ)
+                    order.append(succ)
+        result = dict.fromkeys(order, False)
+        for states in found:
+            result[states] = True
+        while found:
+            for pred in preds.get(found.pop(), ()):
+                if not result[pred]:
+                    result[pred] = True
+                    found.append(pred)
+        live.update(result)
+
+    def prune(self, states):
+        parts = [nfa.prune(p) for nfa, p in zip(self.nfas, self.split(states))]
+        tuples = list(itertools.product(*(part.tolist() for part in parts)))
+        self._explore(tuples)
+        keep = [set() for _ in parts]
+        for states in tuples:
+            if self._live[states]:
+                for kept, q in zip(keep, states):
+                    kept.add(q)
+        return self.join([np.array(sorted(kept), dtype=np.int32) for kept in keep])
+
+    def next_symbols(self, states):
+        # symbols after which the product is still live
+        allowed = np.ones(self.n_symbols, dtype=bool)
+        for nfa, ids, part in zip(self.nfas, self.maps, self.split(states)):
+            allowed &= np.isin(ids, nfa.next_symbols(part))
+        return np.array(
+            [
+                sym
+                for sym in np.flatnonzero(allowed).tolist()
+                if len(self.prune(self.step(states, sym)))
+            ],
+            dtype=np.int64,
+        )
+
+    def arrays(self):
+        return {
+            f"{i}.{name}": a
+            for i, nfa in enumerate(self.nfas)
+            for name, a in nfa.arrays().items()
+        }
+
+    def nbytes(self):
+        return sum(nfa.nbytes() for nfa in self.nfas)
+
+    def shared_meta(self):
+        return [(type(nfa), nfa.shared_meta()) for nfa in self.nfas]
+
+    @classmethod
+    def from_shared(cls, meta, arrays):
+        nfas = []
+        for i, (nfa_class, nfa_meta) in enumerate(meta):
+            prefix = f"{i}."
+            nfa_arrays = {
+                name[len(prefix) :]: a
+                for name, a in arrays.items()
+                if name.startswith(prefix)
+            }
+            nfas.append(nfa_class.from_shared(nfa_meta, nfa_arrays))
+        return cls(nfas)
+
+
+def build_automaton(parsed, unroll_limit=UNROLL_LIMIT, stats=None, max_states=None):
+    # parse tree -> the automaton every matcher runs on; sizes and timings are
+    # added to the stats dict, if one is given
+    while type(parsed) is Group:
+        parsed = parsed.item
+    if type(parsed) is Intersection:
+        return IntersectionNFA(
+            [build_automaton(p, unroll_limit, stats, max_states) for p in parsed.items]
+        )
+    if stats is None:
+        return eliminate_epsilons(
+            compile_nfa(parse_tree_to_nfa(parsed, unroll_limit, max_states))
+        )
+    t0 = time.perf_counter()
+    nfa = parse_tree_to_nfa(parsed, unroll_limit, max_states)
+    compiled = compile_nfa(nfa)
+    t1 = time.perf_counter()
+    optimized = eliminate_epsilons(compiled)
+    t2 = time.perf_counter()
+    edges = [
+        (obs, len(dests))
+        for transitions in nfa.values()
+        for obs, dests in transitions.items()
+    ]
+    counts = {
+        "construct_seconds": t1 - t0,
+        "optimize_seconds": t2 - t1,
+        "nfa_states": len(nfa),
+        "nfa_transitions": sum(n for obs, n in edges if obs != ""),
+        "epsilon_edges": sum(n for obs, n in edges if obs == ""),
+        "states": optimized.n_states,
+        "transitions": len(optimized.sym_dests),
+    }
+    for key, value in counts.items():
+        stats[key] = stats.get(key, 0) + value
+    return optimized
+
+
+# Thompson-style simulation: one epsilon-closed set of active states per input
+# position instead of a stack of pennies. O(len(s) * |states|), constant memory
+# in len(s), and gives the same answers as check.
+
+
+def simulate(nfa, s):
+    if isinstance(nfa, dict):
+        nfa = compile_nfa(nfa)
+    states = nfa.initial()
+    for c in s:
+        states = nfa.step(states, nfa.classify(c))
+        if not len(states):
+            return False
+    return nfa.accepts(states)
+
+
+# Incremental matching for constrained decoding: a Matcher holds only the
+# current active state set, pruned to states that can still reach an accepting
+# state, so a prefix with no possible completion is reported dead immediately.
+
+
+class Matcher:
+    def __init__(self, nfa):
+        if isinstance(nfa, dict):
+            nfa = compile_nfa(nfa)
+        self.nfa = nfa
+        self.reset()
+
+    def reset(self):
+        self.states = self.nfa.prune(self.nfa.initial())
+
+    def feed(self, token):
+        nfa = self.nfa
+        self.states = nfa.prune(nfa.step(self.states, nfa.classify(token)))
+        return not self.is_dead()
+
+    def is_accepting(self):
+        return self.nfa.accepts(self.states)
+
+    def is_dead(self):
+        return not len(self.states)
+
+    def allowed_next(self):
+        # symbols that keep the match alive; ANY_CHAR means any symbol that
+        # the pattern doesn't mention
+        syms = self.nfa.next_symbols(self.states)
+        return {self.nfa.alphabet.symbol_list[sym] for sym in syms.tolist()}
+
+
+# Lazy subset construction: DFA states are built on demand from NFA state sets
+# and (dfa state, symbol) -> dfa state transitions are memoized in a table of
+# at most max_states rows. A full table is flushed and rebuilt; a match that
+# keeps flushing the cache finishes on the NFA instead.
+
+UNKNOWN = -1
+DEAD = 0
+
+
+class LazyDFA:
+    def __init__(self, nfa, max_states=4096, max_flushes=2):
+        if isinstance(nfa, dict):
+            nfa = compile_nfa(nfa)
+        assert max_states >= 4, "the cache needs room for dead, start and one step"
+        self.nfa = nfa
+        self.max_states = max_states
+        self.max_flushes = max_flushes
+        self.table = np.full((max_states, nfa.n_symbols), UNKNOWN, dtype=np.int32)
+        self.accepting = np.zeros(max_states, dtype=bool)
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.fallbacks = 0
+        self._reset()
+
+    def _reset(self):
+        self.table.fill(UNKNOWN)
+        self.sets = []
+        self.ids = {}
+        self._add(np.zeros(0, dtype=np.int32))
+        self.start = self._add(self.nfa.initial())
+
+    def _add(self, states):
+        key = states.tobytes()
+        if key not in self.ids:
+            if len(self.sets) == self.max_states:
+                return None
+            self.ids[key] = len(self.sets)
+            self.accepting[len(self.sets)] = self.nfa.accepts(states)
+            self.sets.append(states)
+        return self.ids[key]
+
+    def next(self, d, sym, budget=None):
+        next_d = self.table[d, sym]
+        if next_d != UNKNOWN:
+            self.hits += 1
+            return next_d
+        self.misses += 1
+        states = self.nfa.step(self.sets[d], sym, budget)
+        next_d = self._add(states)
+        if next_d is None:
+            current = self.sets[d]
+            self.flushes += 1
+            self._reset()
+            d = self._add(current)
+            next_d = self._add(states)
+        self.table[d, sym] = next_d
+        return next_d
+
+    def _run(self, s, budget=None):
+        # final DFA state, or (DEAD, NFA state set) if the cache thrashed and
+        # the match was finished on the NFA
+        d = self.start
+        flushes = self.flushes
+        for i, c in enumerate(s):
+            if budget is not None:
+                budget.spend()
+            d = self.next(d, self.nfa.classify(c), budget)
+            if d == DEAD:
+                return DEAD, None
+            if self.flushes - flushes > self.max_flushes:
+                # the cache is thrashing on this input; finish on the NFA
+                self.fallbacks += 1
+                states = self.sets[d]
+                for c in s[i + 1 :]:
+                    if budget is not None:
+                        budget.spend()
+                    states = self.nfa.step(states, self.nfa.classify(c), budget)
+                    if not len(states):
+                        break
+                return DEAD, states
+        return d, None
+
+    def match(self, s, budget=None):
+        d, states = self._run(s, budget)
+        if states is not None:
+            return self.nfa.accepts(states)
+        return bool(self.accepting[d])
+
+    def run(self, s):
+        # NFA state set reached after s, empty once no match is possible
+        d, states = self._run(s)
+        return self.sets[d] if states is None else states
+
+    def _resume(self, states, syms):
+        d = self._add(states)
+        if d is None:
+            self.flushes += 1
+            self._reset()
+            d = self._add(states)
+        for sym in syms:
+            d = self.next(d, sym)
+            if d == DEAD:
+                return False
+        return bool(self.accepting[d])
+
+    def match_many(self, syms, lengths):
+        # Steps every row of the padded symbol array at once: one vectorized
+        # table lookup per position, with Python only filling in unknown
+        # (state, symbol) pairs. If filling flushes the cache, the remaining
+        # rows are finished one at a time from their NFA state sets.
+        result = np.zeros(len(lengths), dtype=bool)
+        d = np.full(len(lengths), self.start, dtype=np.int32)
+        for i in range(syms.shape[1] + 1):
+            done = lengths == i
+            result[done] = self.accepting[d[done]]
+            if i == syms.shape[1]:
+                break
+            rows = np.flatnonzero((lengths > i) & (d != DEAD))
+            if not len(rows):
+                break
+            cur, sym = d[rows], syms[rows, i]
+            next_d = self.table[cur, sym]
+            missing = next_d == UNKNOWN
+            if missing.any():
+                sets = {x: self.sets[x] for x in np.unique(cur).tolist()}
+                flushes = self.flushes
+                n_symbols = self.nfa.n_symbols
+                pairs = np.unique(
+                    cur[missing].astype(np.int64) * n_symbols + sym[missing]
+                )
+                for pair in pairs.tolist():
+                    self.next(*divmod(pair, n_symbols))
+                    if self.flushes != flushes:
+                        break
+                if self.flushes != flushes:
+                    for row, row_d in zip(rows.tolist(), cur.tolist()):
+                        result[row] = self._resume(
+                            sets[row_d], syms[row, i : lengths[row]].tolist()
+                        )
+                    return result
+                next_d = self.table[cur, sym]
+            d[rows] = next_d
+        return result
+
+    def longest_match(self, s, pos=0, budget=None):
+        # end of the longest match of s[pos:end], or None
+        d = self.start
+        end = pos if self.accepting[d] else None
+        for i in range(pos, len(s)):
+            if budget is not None:
+                budget.spend()
+            d = self.next(d, self.nfa.classify(s[i]), budget)
+            if d == DEAD:
+                break
+            if self.accepting[d]:
+                end = i + 1
+        return end
+
+    def stats(self):
+        return {
+            "states": len(self.sets),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+            "fallbacks": self.fallbacks,
+        }
+
+
+# Ahead-of-time DFAs: determinize() runs the full subset construction,
+# minimize() merges equivalent states with Hopcroft's partition refinement,
+# and save()/load() store the result in the versioned on-disk layout so that
+# workers can map a ready-to-run table without parsing or building anything.
+# State 0 is always the dead state, as in LazyDFA.
+
+
+class DFA:
+    def __init__(self, alphabet, start, accepting, table):
+        self.alphabet = alphabet
+        self.symbols = alphabet.symbols
+        self.n_symbols = alphabet.n_symbols
+        self.n_states = len(accepting)
+        self.start = start
+        self.accepting = accepting
+        self.table = table
+
+    def classify(self, c):
+        return self.alphabet.classify(c)
+
+    def match(self, s):
+        d = self.start
+        for c in s:
+            d = self.table[d, self.classify(c)]
+            if d == DEAD:
+                return False
+        return bool(self.accepting[d])
+
+    def longest_match(self, s, pos=0):
+        d = self.start
+        end = pos if self.accepting[d] else None
+        for i in range(pos, len(s)):
+            d = self.table[d, self.classify(s[i])]
+            if d == DEAD:
+                break
+            if self.accepting[d]:
+                end = i + 1
+        return end
+
+    def match_many(self, syms, lengths):
+        d = np.full(len(lengths), self.start, dtype=np.int32)
+        for i in range(syms.shape[1]):
+            rows = np.flatnonzero(lengths > i)
+            d[rows] = self.table[d[rows], syms[rows, i]]
+        return self.accepting[d]
+
+    def save(self, path):
+        meta = {"symbols": list(self.symbols), "start": self.start}
+        arrays = {"accepting": self.accepting, "table": self.table}
+        save_arrays(path, "dfa", meta, dict(arrays, **self.alphabet.arrays()))
+
+    @classmethod
+    def load(cls, path):
+        meta, arrays = load_arrays(path, "dfa")
+        symbols = {symbol: i + 1 for i, symbol in enumerate(meta["symbols"])}
+        alphabet = Alphabet(symbols, arrays["boundaries"], arrays["interval_ids"])
+        return cls(alphabet, meta["start"], arrays["accepting"], arrays["table"])
+
+
+def determinize(nfa, max_states=1 << 16):
+    start = nfa.initial()
+    sets = [np.zeros(0, dtype=np.int32), start]
+    ids = {sets[0].tobytes(): DEAD, start.tobytes(): 1}
+    rows = []
+    for states in sets:
+        row = []
+        for sym in range(nfa.n_symbols):
+            next_states = nfa.step(states, sym)
+            key = next_states.tobytes()
+            if key not in ids:
+                if len(sets) >= max_states:
+                    raise BudgetExceeded(
+                        f"DFA has more than {max_states} states", max_states
+                    )
+                ids[key] = len(sets)
+                sets.append(next_states)
+            row.append(ids[key])
+        rows.append(row)
+    accepting = np.array([nfa.accepts(states) for states in sets], dtype=bool)
+    table = np.array(rows, dtype=np.int32).reshape(len(sets), nfa.n_symbols)
+    return DFA(nfa.alphabet, 1, accepting, table)
+
+
+def minimize(dfa):
+    n, k = dfa.n_states, dfa.n_symbols
+    # preds[sym][q] = states p with table[p, sym] == q
+    preds = []
+    for sym in range(k):
+        indptr, srcs = _csr(n, dfa.table[:, sym], np.arange(n))
+        indptr, srcs = indptr.tolist(), srcs.tolist()
+        preds.append([srcs[indptr[q] : indptr[q + 1]] for q in range(n)])
+
+    accepting = set(np.flatnonzero(dfa.accepting).tolist())
+    blocks = [b for b in (accepting, set(range(n)) - accepting) if b]
+    block_of = [0] * n
+    for b, block in enumerate(blocks):
+        for q in block:
+            block_of[q] = b
+    work = {
+        (min(range(len(blocks)), key=lambda b: len(blocks[b])), sym) for sym in range(k)
+    }
+    while work:
+        b, sym = work.pop()
+        splitter = set()
+        for q in blocks[b]:
+            splitter.update(preds[sym][q])
+        touched = {}
+        for p in splitter:
+            touched.setdefault(block_of[p], set()).add(p)
+        for y, inside in touched.items():
+            if len(inside) == len(blocks[y]):
+                continue
+            outside = blocks[y] - inside
+            blocks[y] = inside
+            new = len(blocks)
+            blocks.append(outside)
+            for q in outside:
+                block_of[q] = new
+            for c in range(k):
+                if (y, c) in work:
+                    work.add((new, c))
+                else:
+                    work.add((y if len(inside) <= len(outside) else new, c))
+
+    # renumber blocks: the dead state's block first, then BFS order from start
+    order = {block_of[DEAD]: 0}
+    queue = [block_of[dfa.start]]
+    order.setdefault(queue[0], len(order))
+    for b in queue:
+        q = next(iter(blocks[b]))
+        for next_q in dfa.table[q].tolist():
+            if block_of[next_q] not in order:
+                order[block_of[next_q]] = len(order)
+                queue.append(block_of[next_q])
+    reps = [None] * len(order)
+    for b, new in order.items():
+        reps[new] = next(iter(blocks[b]))
+    remap = np.zeros(len(blocks), dtype=np.int32)
+    for b, new in order.items():
+        remap[b] = new
+    table = remap[np.array(block_of, dtype=np.int32)[dfa.table[reps]]]
+    return DFA(dfa.alphabet, order[block_of[dfa.start]], dfa.accepting[reps], table)
+
+
+def compile_dfa(pattern, max_states=1 << 16):
+    return minimize(determinize(compile(pattern).nfa, max_states))
+
+
+# Search prefilters. literal_info finds literals that every match of a parse
+# tree must contain, as tuples of symbols: a required prefix, and otherwise the
+# longest required substring. search() jumps between occurrences of that
+# literal with str.find (or list.index for token sequences) and only starts the
+# automaton where a match is still possible.
+
+
+def _common_prefix(seqs):
+    prefix = seqs[0]
+    for seq in seqs[1:]:
+        n = 0
+        while n < min(len(prefix), len(seq)) and prefix[n] == seq[n]:
+            n += 1
+        prefix = prefix[:n]
+    return prefix
+
+
+def literal_info(node):
+    # (exact, prefix, suffix, factor): the only string the node matches, or
+    # None if it matches several, and a prefix, suffix and substring shared by
+    # all of its matches
+    if type(node) is Group:
+        return literal_info(node.item)
+    if type(node) is Literal:
+        exact = tuple(node.text)
+        return exact, exact, exact, exact
+    if type(node) is Symbol:
+        label = node.label
+        if isinstance(label, SymbolClass):
+            (lo, hi), *rest = label.ranges or [(0, -1)]
+            single = lo == hi and not rest and not label.tokens and not label.negated
+            label = chr(lo) if single else ANY_CHAR
+        if label is ANY_CHAR:
+            return None, (), (), ()
+        return (label,), (label,), (label,), (label,)
+    if type(node) is Concat:
+        exact = prefix = suffix = factor = ()
+        for item in node.items:
+            item_exact, item_prefix, item_suffix, item_factor = literal_info(item)
+            factor = max(factor, item_factor, suffix + item_prefix, key=len)
+            if exact is not None:
+                prefix = exact + item_prefix
+            suffix = item_suffix if item_exact is None else suffix + item_exact
+            exact = None if exact is None or item_exact is None else exact + item_exact
+        return exact, prefix, suffix, max(factor, prefix, suffix, key=len)
+    if type(node) is Alternation:
+        infos = [literal_info(item) for item in node.items]
+        exacts = {info[0] for info in infos}
+        exact = exacts.pop() if len(exacts) == 1 else None
+        prefix = _common_prefix([info[1] for info in infos])
+        suffix = _common_prefix([info[2][::-1] for info in infos])[::-1]
+        return exact, prefix, suffix, max(prefix, suffix, key=len)
+    if type(node) is Intersection:
+        infos = [literal_info(item) for item in node.items]
+        exact = next((info[0] for info in infos if info[0] is not None), None)
+        return (exact,) + tuple(
+            max((info[i] for info in infos), key=len) for i in (1, 2, 3)
+        )
+    if type(node) is Repeat:
+        if node.minimum == 0:
+            return (() if node.maximum == 0 else None), (), (), ()
+        item_exact, prefix, suffix, factor = literal_info(node.item)
+        if item_exact is None:
+            return None, prefix, suffix, factor
+        required = item_exact * node.minimum
+        exact = required if node.maximum == node.minimum else None
+        return exact, required, required, required
+    assert False, f"not a parse tree node: {node!r}"
+
+
+def max_length(node):
+    # length of the longest match of the node, or None if it is unbounded
+    if type(node) is Group:
+        return max_length(node.item)
+    if type(node) is Literal:
+        return len(node.text)
+    if type(node) is Symbol:
+        return 1
+    if type(node) is Repeat:
+        if node.maximum == 0:
+            return 0
+        item = max_length(node.item)
+        return None if item is None or node.maximum is None else item * node.maximum
+    lengths = [max_length(item) for item in node.items]
+    if type(node) is Intersection:
+        return min((n for n in lengths if n is not None), default=None)
+    if None in lengths:
+        return None
+    return sum(lengths) if type(node) is Concat else max(lengths, default=0)
+
+
+def find_literal(s, literal, start=0):
+    # first index >= start at which s contains the symbols of literal, or -1
+    if isinstance(s, str):
+        if not all(isinstance(c, str) and len(c) == 1 for c in literal):
+            return -1
+        return s.find("".join(literal), start)
+    n = len(literal)
+    try:
+        while True:
+            i = s.index(literal[0], start)
+            if tuple(s[i : i + n]) == literal:
+                return i
+            start = i + 1
+    except ValueError:
+        return -1
+
+
+class Prefilter:
+    __slots__ = ("prefix", "factor", "max_length")
+
+    def __init__(self, tree):
+        _, self.prefix, _, self.factor = literal_info(tree)
+        self.max_length = max_length(tree)
+
+    def candidates(self, s, pos=0):
+        # increasing start positions that a match could begin at
+        if not (isinstance(s, str) or hasattr(s, "index")):
+            yield from range(pos, len(s) + 1)
+        elif self.prefix:
+            start = find_literal(s, self.prefix, pos)
+            while start != -1:
+                yield start
+                start = find_literal(s, self.prefix, start + 1)
+        elif self.factor:
+            start = pos
+            while start <= len(s):
+                found = find_literal(s, self.factor, start)
+                if found == -1:
+                    return
+                if self.max_length is not None:
+                    start = max(start, found + len(self.factor) - self.max_length)
+                while start <= found:
+                    yield start
+                    start += 1
+        else:
+            yield from range(pos, len(s) + 1)
+
+
+# Capture groups. Group spans are only worked out when asked for, once the DFA
+# has fixed the overall span of a match: a Pike VM runs the pattern's program
+# over exactly that span, trying alternatives and repetitions in priority
+# order (leftmost alternative first, repetitions greedy). As in re, a loop
+# whose minimum is met stops after an iteration that matched nothing, but the
+# groups that iteration set are kept, so group spans come out as re reports
+# them. Each thread carries a tuple of slots that it shares with the threads
+# it forks until one of them saves a position, so a step copies nothing but
+# the tuples it writes to. Loops save where their current iteration began in
+# slots after the groups' ones.
+#
+# Repetitions with bounds above UNROLL_LIMIT aren't unrolled, as in the NFA:
+# PUSH starts a counter for the body and COUNT, at the end of each iteration,
+# loops while fewer than the maximum are done and leaves once the minimum is,
+# popping the counter. Threads then carry their counter values, and two
+# threads only merge if these agree too.
+
+FORK, SAVE, SYMBOL, MATCH, MARK, AGAIN, PUSH, COUNT = range(8)
+
+
+class Program:
+    def __init__(self, tree):
+        # ops[pc] = [kind, arg, targets]: FORK and SAVE continue at each of
+        # their targets in order, SYMBOL consumes a symbol matching arg
+        self.ops = []
+        self.n_groups = 0
+        self.n_marks = 0
+        start, exit_ = self.fragment(tree)
+        self.ops[exit_][2].append(self.op(MATCH))
+        self.start = start
+        # loop marks get the slots after the groups', now that those are known
+        base = 2 * self.n_groups + 2
+        self.marks = range(base, base + self.n_marks)
+        for op in self.ops:
+            if op[0] == MARK:
+                op[0], op[1] = SAVE, base + op[1]
+            elif op[0] == AGAIN:
+                op[1] += base
+            elif op[0] == COUNT:
+                op[1] = op[1][:2] + (base + op[1][2],)
+
+    def op(self, kind, arg=None):
+        self.ops.append([kind, arg, []])
+        return len(self.ops) - 1
+
+    def link(self, src, dest):
+        self.ops[src][2].append(dest)
+
+    def mark(self):
+        # (op saving where an iteration begins, the mark's index)
+        self.n_marks += 1
+        return self.op(MARK, self.n_marks - 1), self.n_marks - 1
+
+    def fragment(self, node):
+        if type(node) is Literal or type(node) is Symbol:
+            start = exit_ = self.op(FORK)
+            for label in node.text if type(node) is Literal else [node.label]:
+                sym = self.op(SYMBOL, label)
+                self.link(exit_, sym)
+                exit_ = self.op(FORK)
+                self.link(sym, exit_)
+            return start, exit_
+        if type(node) is Group:
+            self.n_groups = max(self.n_groups, node.index)
+            start = self.op(SAVE, 2 * node.index)
+            exit_ = self.op(SAVE, 2 * node.index + 1)
+            inner_start, inner_exit = self.fragment(node.item)
+            self.link(start, inner_start)
+            self.link(inner_exit, exit_)
+            return start, exit_
+        if type(node) is Concat:
+            start = exit_ = self.op(FORK)
+            for item in node.items:
+                item_start, item_exit = self.fragment(item)
+                self.link(exit_, item_start)
+                exit_ = item_exit
+            return start, exit_
+        if type(node) is Alternation:
+            start, exit_ = self.op(FORK), self.op(FORK)
+            for item in node.items:
+                item_start, item_exit = self.fragment(item)
+                self.link(start, item_start)
+                self.link(item_exit, exit_)
+            return start, exit_
+        if type(node) is Repeat:
+            bound = node.minimum if node.maximum is None else node.maximum
+            if bound > UNROLL_LIMIT:
+                return self.counted(node)
+            start = exit_ = self.op(FORK)
+            for _ in range(node.minimum):
+                item_start, item_exit = self.fragment(node.item)
+                self.link(exit_, item_start)
+                exit_ = item_exit
+            out = self.op(FORK)
+            if node.maximum is None:
+                loop = self.op(FORK)
+                mark, index = self.mark()
+                item_start, item_exit = self.fragment(node.item)
+                again = self.op(AGAIN, index)
+                self.link(exit_, loop)
+                self.link(loop, mark)
+                self.link(mark, item_start)
+                self.link(loop, out)
+                self.link(item_exit, again)
+                self.link(again, loop)
+                self.link(again, out)
+                return start, out
+            for _ in range(node.maximum - node.minimum):
+                item_start, item_exit = self.fragment(node.item)
+                self.link(exit_, item_start)
+                self.link(exit_, out)
+                exit_ = item_exit
+            self.link(exit_, out)
+            return start, out
+        if type(node) is Intersection:
+            # the product has no room for the operands' groups, which are
+            # left unset; its states become FORKs in a fixed order
+            nfa = NFA(unroll_limit=None)
+            nfa_start, nfa_exit = and_fragment(nfa, node.items)
+            ops = {}
+
+            def state_op(state):
+                if state not in ops:
+                    ops[state] = self.op(FORK)
+                return ops[state]
+
+            for state, transitions in nfa.items():
+                for obs, dests in transitions.items():
+                    for dest in sorted(dests):
+                        if obs == "":
+                            self.link(state_op(state), state_op(dest))
+                        else:
+                            sym = self.op(SYMBOL, obs)
+                            self.link(state_op(state), sym)
+                            self.link(sym, state_op(dest))
+            return state_op(nfa_start), state_op(nfa_exit)
+        assert False, f"not a parse tree node: {node!r}"
+
+    def counted(self, node):
+        start, push, out = self.op(FORK), self.op(PUSH), self.op(FORK)
+        mark, index = self.mark()
+        item_start, item_exit = self.fragment(node.item)
+        count = self.op(COUNT, (node.minimum, node.maximum, index))
+        self.link(start, push)
+        if node.minimum == 0:
+            self.link(start, out)
+        self.link(push, mark)
+        self.link(mark, item_start)
+        self.link(item_exit, count)
+        self.link(count, mark)
+        self.link(count, out)
+        return start, out
+
+    def follow(self, threads, pos):
+        # closure of threads over everything but SYMBOL and MATCH, in priority
+        # order
+        res = []
+        seen = set()
+        stack = threads[::-1]
+        while stack:
+            pc, slots, counts = stack.pop()
+            # an empty last iteration goes through its loop's ops once more,
+            # so threads only merge if the same loops are in one
+            key = pc, counts, tuple(i for i in self.marks if slots[i] == pos)
+            if key in seen:
+                continue
+            seen.add(key)
+            kind, arg, targets = self.ops[pc]
+            if kind == SAVE:
+                slots = slots[:arg] + (pos,) + slots[arg + 1 :]
+            if kind == AGAIN and slots[arg] == pos:
+                # an empty iteration ends the loop
+                targets = targets[1:]
+            elif kind == PUSH:
+                counts += (0,)
+            elif kind == COUNT:
+                minimum, maximum, arg = arg
+                done = counts[-1] + 1
+                forks = []
+                if (maximum is None or done < maximum) and not (
+                    done >= minimum and slots[arg] == pos
+                ):
+                    # unbounded counters saturate at the minimum
+                    kept = done if maximum is not None else min(done, minimum)
+                    forks.append((targets[0], slots, counts[:-1] + (kept,)))
+                if done >= minimum:
+                    forks.append((targets[1], slots, counts[:-1]))
+                stack.extend(reversed(forks))
+                continue
+            if kind == SYMBOL or kind == MATCH:
+                res.append((pc, slots, counts))
+            else:
+                stack.extend((target, slots, counts) for target in reversed(targets))
+        return res
+
+    def run(self, s, start, end):
+        # slots of the highest priority way to match exactly s[start:end]
+        slots = (start, end) + (None,) * (2 * self.n_groups + self.n_marks)
+        threads = self.follow([(self.start, slots, ())], start)
+        for pos in range(start, end):
+            c = s[pos]
+            moved = []
+            for pc, slots, counts in threads:
+                kind, label, targets = self.ops[pc]
+                if kind == SYMBOL and (
+                    label == c
+                    or label is ANY_CHAR
+                    or isinstance(label, SymbolClass)
+                    and c in label
+                ):
+                    moved.append((targets[0], slots, counts))
+            threads = self.follow(moved, pos + 1)
+        for pc, slots, counts in threads:
+            if self.ops[pc][0] == MATCH:
+                return slots[: 2 * self.n_groups + 2]
+        return None
+
+
+# Compiled patterns. compile() parses and builds a pattern once and keeps it in
+# a thread-safe LRU cache keyed by the pattern string, like re's own cache.
+# Matching follows leftmost-longest semantics. Each thread gets its own DFA
+# cache so that compiled patterns can be shared freely.
+
+
+class Match:
+    __slots__ = ("string", "_start", "_end", "_pattern", "_slots")
+
+    def __init__(self, string, start, end, pattern=None):
+        self.string = string
+        self._start = start
+        self._end = end
+        self._pattern = pattern
+        self._slots = None
+
+    def span(self, group=0):
+        # (-1, -1) for a group that took no part in the match
+        if group == 0:
+            return self._start, self._end
+        n_groups = 0 if self._pattern is None else self._pattern.groups
+        if not 0 < group <= n_groups:
+            raise IndexError(f"no such group {group}")
+        if self._slots is None:
+            self._slots = self._pattern.program.run(self.string, self._start, self._end)
+        lo, hi = self._slots[2 * group : 2 * group + 2]
+        return (-1, -1) if lo is None else (lo, hi)
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+    def group(self, group=0):
+        lo, hi = self.span(group)
+        return None if lo == -1 else self.string[lo:hi]
+
+    def groups(self):
+        n_groups = 0 if self._pattern is None else self._pattern.groups
+        return tuple(self.group(i) for i in range(1, n_groups + 1))
+
+    def __repr__(self):
+        return f"<Match span={self.span()} match={self.group()!r}>"
+
+
+class Pattern:
+    __slots__ = ("_pattern", "_nfa", "_prefilter", "_program", "_local")
+
+    def __init__(self, pattern, stats=None, max_states=None):
+        self._pattern = pattern
+        t0 = time.perf_counter()
+        tree = parse(pattern)
+        if stats is not None:
+            stats["parse_seconds"] = time.perf_counter() - t0
+        self._nfa = build_automaton(tree, stats=stats, max_states=max_states)
+        self._prefilter = Prefilter(tree)
+        self._program = None
+        self._local = threading.local()
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def nfa(self):
+        return self._nfa
+
+    @property
+    def program(self):
+        # the Pike VM program for capture groups, built on first use
+        if self._program is None:
+            self._program = Program(parse(self._pattern))
+        return self._program
+
+    @property
+    def groups(self):
+        return self.program.n_groups
+
+    @property
+    def dfa(self):
+        dfa = getattr(self._local, "dfa", None)
+        if dfa is None:
+            dfa = self._local.dfa = LazyDFA(self._nfa)
+        return dfa
+
+    # max_steps and deadline bound a single call, see Budget
+
+    def fullmatch(self, s, max_steps=None, deadline=None):
+        if self.dfa.match(s, new_budget(max_steps, deadline)):
+            return Match(s, 0, len(s), self)
+        return None
+
+    def match(self, s, max_steps=None, deadline=None):
+        end = self.dfa.longest_match(s, 0, new_budget(max_steps, deadline))
+        if end is None:
+            return None
+        return Match(s, 0, end, self)
+
+    def search(self, s, pos=0, max_steps=None, deadline=None):
+        dfa = self.dfa
+        budget = new_budget(max_steps, deadline)
+        for start in self._prefilter.candidates(s, pos):
+            end = dfa.longest_match(s, start, budget)
+            if end is not None:
+                return Match(s, start, end, self)
+        return None
+
+    def finditer(self, s, pos=0):
+        # non-overlapping matches, left to right
+        while pos <= len(s):
+            m = self.search(s, pos)
+            if m is None:
+                return
+            yield m
+            pos = m.end() if m.end() > m.start() else m.end() + 1
+
+    def findall(self, s):
+        return [m.group() for m in self.finditer(s)]
+
+    def match_many(self, sequences, lengths=None):
+        # whole-sequence matches for a batch, as a boolean array
+        syms, lengths = encode_batch(self._nfa, sequences, lengths)
+        return self.dfa.match_many(syms, lengths)
+
+    def matcher(self):
+        return Matcher(self._nfa)
+
+    def match_parallel(self, sequences, lengths=None, workers=None, chunksize=10000):
+        return match_parallel(self, sequences, lengths, workers, chunksize)
+
+    def __repr__(self):
+        return f"tok_regex.compile({self._pattern!r})"
+
+
+# Pattern sets. Many patterns are matched in one pass over the input by
+# combining them as p_0 <tag 0> | p_1 <tag 1> | ..., where tag i is a symbol
+# that never occurs in the input. After the scan, pattern i matched iff the
+# final state set accepts after one more step on tag i; those lookups are
+# memoized per final state set.
+
+
+class PatternTag:
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __eq__(self, other):
+        return type(other) is PatternTag and other.index == self.index
+
+    def __hash__(self):
+        return hash((PatternTag, self.index))
+
+    def __repr__(self):
+        return f"<tag {self.index}>"
+
+
+class PatternSet:
+    __slots__ = ("_patterns", "_nfas", "_found", "_local")
+
+    def __init__(self, patterns):
+        # patterns are pattern strings or parse trees
+        self._patterns = list(patterns)
+        self._nfas = {}
+        self._found = {}
+        self._local = threading.local()
+
+    def __len__(self):
+        return len(self._patterns)
+
+    @property
+    def patterns(self):
+        return self._patterns
+
+    def nfa(self, mode="fullmatch"):
+        # the combined automaton, for mode "fullmatch" or "search"
+        if mode not in self._nfas:
+            anything = Repeat(Symbol(ANY_CHAR), 0, None)
+            alternatives = []
+            for i, pattern in enumerate(self._patterns):
+                tree = parse(pattern) if isinstance(pattern, str) else pattern
+                if mode == "search":
+                    tree = Concat([tree, anything])
+                alternatives.append(Concat([tree, Symbol(PatternTag(i))]))
+            tree = Alternation(alternatives)
+            if mode == "search":
+                tree = Concat([anything, tree])
+            nfa = build_automaton(tree)
+            # patterns that can never match have no reachable tag
+            tags = {
+                nfa.symbols[tag]: tag.index
+                for tag in map(PatternTag, range(len(self._patterns)))
+                if tag in nfa.symbols
+            }
+            self._found.setdefault(mode, {})
+            self._nfas[mode] = nfa, tags
+        return self._nfas[mode]
+
+    def dfa(self, mode="fullmatch"):
+        dfas = self._local.__dict__.setdefault("dfas", {})
+        if mode not in dfas:
+            dfas[mode] = LazyDFA(self.nfa(mode)[0])
+        return dfas[mode]
+
+    def _matches(self, s, mode):
+        # indices of the patterns matching s, in order
+        nfa, tags = self.nfa(mode)
+        states = self.dfa(mode).run(s)
+        key = states.tobytes()
+        found = self._found[mode].get(key)
+        if found is None:
+            candidates = [
+                sym for sym in nfa.next_symbols(states).tolist() if sym in tags
+            ]
+            found = sorted(
+                tags[sym] for sym in candidates if nfa.accepts(nfa.step(states, sym))
+            )
+            self._found[mode][key] = found
+        return list(found)
+
+    def fullmatch(self, s):
+        return self._matches(s, "fullmatch")
+
+    def search(self, s):
+        # patterns that match somewhere in s
+        return self._matches(s, "search")
+
+    def __repr__(self):
+        return f"tok_regex.PatternSet({self._patterns!r})"
+
+
+# Parallel matching. The compiled tables are copied once into a shared memory
+# block that every worker maps at startup, so tasks only carry their chunk of
+# sequences. Chunks come back in input order.
+
+
+def array_layout(arrays):
+    layout = []
+    offset = 0
+    for name, a in arrays.items():
+        offset = -(-offset // 8) * 8
+        layout.append((name, a.dtype.str, a.shape, offset))
+        offset += a.nbytes
+    return layout, offset
+
+
+def arrays_from_buffer(buf, layout):
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        for name, dtype, shape, offset in layout
+    }
+
+
+# On-disk format for compiled tables: magic, format version and header length,
+# a JSON header describing the arrays, then the arrays themselves, 64-byte
+# aligned so that load_arrays can map them straight from the file.
+
+FILE_MAGIC = b"TOKREGEX"
+FILE_VERSION = 1
+
+
+def save_arrays(path, kind, meta, arrays):
+    layout, nbytes = array_layout(arrays)
+    header = json.dumps({"kind": kind, "meta": meta, "layout": layout}).encode()
+    data_start = -(-(16 + len(header)) // 64) * 64
+    with open(path, "wb") as f:
+        f.write(FILE_MAGIC + struct.pack("<II", FILE_VERSION, len(header)) + header)
+        for name, dtype, shape, offset in layout:
+            f.seek(data_start + offset)
+            f.write(np.ascontiguousarray(arrays[name]).tobytes())
+        f.truncate(data_start + nbytes)
+
+
+def load_arrays(path, kind):
+    # files may come from anywhere, so every check raises ValueError
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < 16 or mm[:8] != FILE_MAGIC:
+        raise ValueError(f"{path} is not a tok_regex file")
+    version, header_len = struct.unpack("<II", mm[8:16])
+    if version != FILE_VERSION:
+        raise ValueError(f"{path} has unsupported format version {version}")
+    header = json.loads(mm[16 : 16 + header_len])
+    if header.get("kind") != kind:
+        raise ValueError(f"{path} holds a {header.get('kind')}, not a {kind}")
+    data_start = -(-(16 + header_len) // 64) * 64
+    try:
+        arrays = arrays_from_buffer(memoryview(mm)[data_start:], header["layout"])
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{path} is truncated or corrupt: {e}") from None
+    return header["meta"], arrays
+
+
+_worker = {}
+
+
+def _init_worker(shm_name, layout, nfa_class, meta):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    nfa = nfa_class.from_shared(meta, arrays_from_buffer(shm.buf, layout))
+    _worker["shm"] = shm
+    _worker["dfa"] = LazyDFA(nfa)
+
+
+def _match_chunk(chunk):
+    sequences, lengths = chunk
+    dfa = _worker["dfa"]
+    return dfa.match_many(*encode_batch(dfa.nfa, sequences, lengths))
+
+
+def match_parallel(pattern, sequences, lengths=None, workers=None, chunksize=10000):
+    nfa = compile(pattern).nfa
+    arrays = nfa.arrays()
+    layout, nbytes = array_layout(arrays)
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    try:
+        for name, a in arrays_from_buffer(shm.buf, layout).items():
+            a[...] = arrays[name]
+        chunks = [
+            (
+                sequences[i : i + chunksize],
+                None if lengths is None else lengths[i : i + chunksize],
+            )
+            for i in range(0, len(sequences), chunksize)
+        ]
+        with futures.ProcessPoolExecutor(
+            workers,
+            initializer=_init_worker,
+            initargs=(shm.name, layout, type(nfa), nfa.shared_meta()),
+        ) as pool:
+            results = list(pool.map(_match_chunk, chunks))
+    finally:
+        shm.close()
+        shm.unlink()
+    if not results:
+        return np.zeros(0, dtype=bool)
+    return np.concatenate(results)
+
+
+def encode_batch(nfa, sequences, lengths=None):
+    # Maps a batch to a padded 2-D array of symbol ids plus row lengths. The
+    # batch is either a list of sequences or a padded 2-D numpy array of
+    # symbols, in which case each distinct value is classified only once.
+    if isinstance(sequences, np.ndarray):
+        assert sequences.ndim == 2, "batched input must be 2-D"
+        if lengths is None:
+            lengths = np.full(len(sequences), sequences.shape[1])
+        values, inverse = np.unique(sequences, return_inverse=True)
+        ids = np.array([nfa.classify(v) for v in values.tolist()], dtype=np.int32)
+        syms = ids[inverse].reshape(sequences.shape)
+        return syms, np.asarray(lengths)
+
+    assert lengths is None, "lengths are only used with a padded array"
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    syms = np.zeros((len(sequences), int(lengths.max(initial=0))), dtype=np.int32)
+    flat = list(itertools.chain.from_iterable(sequences))
+    ids = {c: nfa.classify(c) for c in set(flat)}
+    syms[np.arange(syms.shape[1]) < lengths[:, None]] = list(map(ids.__getitem__, flat))
+    return syms, lengths
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "maxsize": 512}
+
+
+def compile(pattern, max_states=None):
+    # a pattern compiled under a max_states limit is cached apart from the
+    # same pattern without one, so the limit is enforced whatever is cached
+    if isinstance(pattern, Pattern):
+        return pattern
+    key = pattern if max_states is None else (pattern, max_states)
+    with _cache_lock:
+        compiled = _cache.get(key)
+        if compiled is not None:
+            _cache.move_to_end(key)
+            _cache_stats["hits"] += 1
+            return compiled
+        _cache_stats["misses"] += 1
+    # build outside the lock so that slow compiles don't serialize other threads
+    if _stats_hook is None:
+        compiled = Pattern(pattern, max_states=max_states)
+    else:
+        compiled = MeasuredPattern(pattern, _stats_hook, max_states)
+    with _cache_lock:
+        compiled = _cache.setdefault(key, compiled)
+        _cache.move_to_end(key)
+        while len(_cache) > _cache_stats["maxsize"]:
+            _cache.popitem(last=False)
+    return compiled
+
+
+def set_cache_size(maxsize):
+    with _cache_lock:
+        _cache_stats["maxsize"] = maxsize
+        while len(_cache) > maxsize:
+            _cache.popitem(last=False)
+
+
+def purge():
+    with _cache_lock:
+        _cache.clear()
+        _cache_stats["hits"] = _cache_stats["misses"] = 0
+
+
+def cache_info():
+    with _cache_lock:
+        return dict(_cache_stats, size=len(_cache))
+
+
+# Opt-in statistics. A MeasuredPattern records how big its automaton came out
+# and where compile time went, and counts steps, the largest active state set
+# and DFA cache hits for every match. Pattern.stats() returns the totals as a
+# dict, and a callable hook is sent one dict per compile and per match. Plain
+# Patterns never touch any of this, so disabled stats cost nothing. Once
+# set_stats_hook() has installed a hook, compile() returns MeasuredPatterns.
+
+_stats_hook = None
+
+
+def set_stats_hook(hook):
+    # None disables stats, True records them, a callable is also sent events;
+    # the cache is purged so that patterns are compiled again to match
+    global _stats_hook
+    _stats_hook = hook
+    purge()
+
+
+class StatsDFA(LazyDFA):
+    def __init__(self, nfa, *args, **kwargs):
+        self.steps = 0
+        self.peak_active = 0
+        super().__init__(nfa, *args, **kwargs)
+
+    def next(self, d, sym, budget=None):
+        next_d = super().next(d, sym, budget)
+        self.steps += 1
+        self.peak_active = max(self.peak_active, len(self.sets[next_d]))
+        return next_d
+
+    def match_many(self, syms, lengths):
+        # table lookups are vectorized here, so every symbol fed counts as a
+        # step and a hit unless it missed, and the peak covers the whole cache
+        steps, misses = self.steps, self.misses
+        result = super().match_many(syms, lengths)
+        total = int(np.sum(lengths))
+        self.steps = steps + total
+        self.hits += total - (self.misses - misses)
+        self.peak_active = max(self.peak_active, max(map(len, self.sets)))
+        return result
+
+
+class MeasuredPattern(Pattern):
+    __slots__ = ("_stats", "_hook", "_lock")
+
+    def __init__(self, pattern, hook=True, max_states=None):
+        compile_stats = {}
+        t0 = time.perf_counter()
+        super().__init__(pattern, compile_stats, max_states)
+        compile_stats["total_seconds"] = time.perf_counter() - t0
+        self._stats = {
+            "compile": compile_stats,
+            "matches": 0,
+            "steps": 0,
+            "peak_active": 0,
+            "dfa_hits": 0,
+            "dfa_misses": 0,
+        }
+        self._hook = hook
+        self._lock = threading.Lock()
+        self._report(dict(compile_stats, event="compile"))
+
+    @property
+    def dfa(self):
+        dfa = getattr(self._local, "dfa", None)
+        if dfa is None:
+            dfa = self._local.dfa = StatsDFA(self._nfa)
+        return dfa
+
+    def _report(self, event):
+        if callable(self._hook):
+            self._hook(dict(event, pattern=self._pattern))
+
+    def _measure(self, kind, method, *args):
+        dfa = self.dfa
+        steps, hits, misses = dfa.steps, dfa.hits, dfa.misses
+        dfa.peak_active = len(dfa.sets[dfa.start])
+        result = method(*args)
+        event = {
+            "event": kind,
+            "steps": dfa.steps - steps,
+            "peak_active": dfa.peak_active,
+            "dfa_hits": dfa.hits - hits,
+            "dfa_misses": dfa.misses - misses,
+        }
+        with self._lock:
+            self._stats["matches"] += 1
+            for key in ("steps", "dfa_hits", "dfa_misses"):
+                self._stats[key] += event[key]
+            self._stats["peak_active"] = max(
+                self._stats["peak_active"], event["peak_active"]
+            )
+        self._report(event)
+        return result
+
+    def fullmatch(self, s, max_steps=None, deadline=None):
+        return self._measure("fullmatch", super().fullmatch, s, max_steps, deadline)
+
+    def match(self, s, max_steps=None, deadline=None):
+        return self._measure("match", super().match, s, max_steps, deadline)
+
+    def search(self, s, pos=0, max_steps=None, deadline=None):
+        return self._measure("search", super().search, s, pos, max_steps, deadline)
+
+    def match_many(self, sequences, lengths=None):
+        return self._measure("match_many", super().match_many, sequences, lengths)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, compile=dict(self._stats["compile"]))
+        lookups = stats["dfa_hits"] + stats["dfa_misses"]
+        stats["dfa_hit_rate"] = stats["dfa_hits"] / lookups if lookups else None
+        return stats
+
+
+# Async matching. AsyncMatcher.match() queues a sequence under its pattern and
+# waits for the result. A pattern's queue is matched as one match_many batch on
+# an executor once it holds max_batch sequences, or max_wait seconds after the
+# first one arrived, so concurrent requests for a pattern share a single pass
+# and the event loop never runs a match itself. Batches go through compile(),
+# and its cache, in whichever thread or process runs them, so a process pool
+# works as well as the loop's default thread pool.
+
+
+def _match_batch(pattern, sequences, max_states=None):
+    return compile(pattern, max_states).match_many(sequences).tolist()
+
+
+class AsyncMatcher:
+    def __init__(self, executor=None, max_wait=0.001, max_batch=1024, max_states=None):
+        # max_states bounds every pattern compiled for a batch, see compile()
+        assert max_batch >= 1, "a batch needs room for at least one sequence"
+        self.executor = executor
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.max_states = max_states
+        self._queues = {}
+
+    async def match(self, pattern, seq):
+        # whether the pattern (a string or a Pattern) matches all of seq
+        pattern = getattr(pattern, "pattern", pattern)
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(pattern)
+        if queue is None:
+            timer = loop.call_later(self.max_wait, self._flush, pattern)
+            queue = self._queues[pattern] = ([], [], timer)
+        waiter = loop.create_future()
+        queue[0].append(seq)
+        queue[1].append(waiter)
+        if len(queue[0]) >= self.max_batch:
+            self._flush(pattern)
+        return await waiter
+
+    def _flush(self, pattern):
+        sequences, waiters, timer = self._queues.pop(pattern)
+        timer.cancel()
+        batch = asyncio.get_running_loop().run_in_executor(
+            self.executor, _match_batch, pattern, sequences, self.max_states
+        )
+        batch.add_done_callback(partial(self._resolve, waiters))
+
+    @staticmethod
+    def _resolve(waiters, batch):
+        # waiters whose caller was cancelled in the meantime are already done
+        if batch.cancelled() or batch.exception() is not None:
+            error = asyncio.CancelledError() if batch.cancelled() else batch.exception()
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(error)
+            return
+        for waiter, matched in zip(waiters, batch.result()):
+            if not waiter.done():
+                waiter.set_result(matched)
+
+
+# Vocabulary masks for constrained decoding. Every automaton state reachable
+# by whole vocabulary tokens becomes a row holding a packed bitmask of the
+# tokens allowed next and a sparse (token -> next row) table. Tokens are run
+# through the character-level NFA with a trie over the vocabulary so shared
+# prefixes are stepped once, and tokens that the pattern names as whole-token
+# literals (<hello>, <#17>) can also take that transition directly.
+
+
+class VocabIndex:
+    def __init__(
+        self, vocab_size, accepting, masks, next_indptr, next_tokens, next_rows
+    ):
+        self.vocab_size = vocab_size
+        self.accepting = accepting
+        self.masks = masks
+        self.next_indptr = next_indptr
+        self.next_tokens = next_tokens
+        self.next_rows = next_rows
+
+    @property
+    def n_rows(self):
+        return len(self.accepting)
+
+    def mask(self, row):
+        # packed, little-endian bit order: token i is bit i % 8 of byte i // 8
+        return self.masks[row]
+
+    def allowed(self, row):
+        bits = np.unpackbits(self.masks[row], count=self.vocab_size, bitorder="little")
+        return bits.view(bool)
+
+    def is_accepting(self, row):
+        return bool(self.accepting[row])
+
+    def advance(self, row, token_id):
+        lo, hi = self.next_indptr[row], self.next_indptr[row + 1]
+        i = lo + np.searchsorted(self.next_tokens[lo:hi], token_id)
+        if i < hi and self.next_tokens[i] == token_id:
+            return int(self.next_rows[i])
+        return None
+
+    def arrays(self):
+        return {
+            "accepting": self.accepting,
+            "masks": self.masks,
+            "next_indptr": self.next_indptr,
+            "next_tokens": self.next_tokens,
+            "next_rows": self.next_rows,
+        }
+
+    def save(self, path):
+        save_arrays(path, "vocab_index", {"vocab_size": self.vocab_size}, self.arrays())
+
+    @classmethod
+    def load(cls, path):
+        meta, arrays = load_arrays(path, "vocab_index")
+        return cls(meta["vocab_size"], **arrays)
+
+    @classmethod
+    def cached(cls, pattern, vocab, cache_dir):
+        key = hashlib.sha256(json.dumps([pattern, list(vocab)]).encode()).hexdigest()
+        path = os.path.join(cache_dir, f"{key[:32]}.vocab")
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            cls.build(pattern, vocab).save(tmp_path)
+            os.replace(tmp_path, path)
+        return cls.load(path)
+
+    @classmethod
+    def build(cls, pattern, vocab):
+        nfa = compile(pattern).nfa
+
+        trie = [{}]
+        ends = [[]]
+        whole = {}
+        for token_id, token in enumerate(vocab):
+            node = 0
+            for c in token:
+                if c not in trie[node]:
+                    trie[node][c] = len(trie)
+                    trie.append({})
+                    ends.append([])
+                node = trie[node][c]
+            ends[node].append(token_id)
+            for key in (token, token_id):
+                if key in nfa.symbols and not (isinstance(key, str) and len(key) == 1):
+                    whole[token_id] = nfa.symbols[key]
+
+        sets = {}
+        steps = {}
+
+        def intern(states):
+            key = states.tobytes()
+            sets.setdefault(key, states)
+            return key
+
+        def step(key, sym):
+            if (key, sym) not in steps:
+                steps[key, sym] = intern(nfa.prune(nfa.step(sets[key], sym)))
+            return steps[key, sym]
+
+        start = intern(nfa.prune(nfa.initial()))
+        rows = {start: 0} if sets[start].size else {}
+        queue = list(rows)
+        outs = []
+        for key in queue:
+            out = {}
+            stack = [(0, key)]
+            while stack:
+                node, node_key = stack.pop()
+                for token_id in ends[node]:
+                    out[token_id] = node_key
+                for c, child in trie[node].items():
+                    child_key = step(node_key, nfa.classify(c))
+                    if child_key:
+                        stack.append((child, child_key))
+            for token_id, sym in whole.items():
+                token_key = step(key, sym)
+                if token_key and token_id in out:
+                    token_key = intern(np.union1d(sets[out[token_id]], sets[token_key]))
+                if token_key:
+                    out[token_id] = token_key
+            for next_key in out.values():
+                if next_key not in rows:
+                    rows[next_key] = len(rows)
+                    queue.append(next_key)
+            outs.append(out)
+
+        masks = np.zeros((len(rows), -(-len(vocab) // 8)), dtype=np.uint8)
+        next_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        next_tokens = []
+        next_rows = []
+        for row, out in enumerate(outs):
+            tokens = sorted(out)
+            allowed = np.zeros(len(vocab), dtype=bool)
+            allowed[tokens] = True
+            masks[row] = np.packbits(allowed, bitorder="little")
+            next_indptr[row + 1] = next_indptr[row] + len(tokens)
+            next_tokens.extend(tokens)
+            next_rows.extend(rows[out[token_id]] for token_id in tokens)
+        accepting = np.array([nfa.accepts(sets[key]) for key in rows], dtype=bool)
+        return cls(
+            len(vocab),
+            accepting,
+            masks,
+            next_indptr,
+            np.array(next_tokens, dtype=np.int32),
+            np.array(next_rows, dtype=np.int32),
+        )
+
 
 def see(nfa, s):
-    print(f'{s}: {check(nfa, s)}')
+    print(f"{s}: {check(nfa, s)}")
+
+
+def demo():
+    s = r'[ab]{3}'
+    s = r"\([0123456789]{3}\) [0123456789]{3}-[0123456789]{4,}"
+    nfa = parse_tree_to_nfa(parse(s))
+    see(nfa, "aaa")
+    see(nfa, "aaaa")
+    see(nfa, "bbb")
+    see(nfa, "(123) 456-7890")
+
+
+# Command line: python -m tok_regex PATTERN [FILE...] prints the lines that
+# contain a match, like grep. Files are memory-mapped and stdin is read in
+# large chunks. Lines are matched in batches, which --workers spreads over
+# processes while output stays in input order.
+
+LINE_BATCH = 10000
+
+
+def read_lines(path):
+    # lines of a file, or of stdin for "-", as bytes with their newlines
+    if path == "-":
+        with open(sys.stdin.fileno(), "rb", buffering=1 << 20, closefd=False) as f:
+            yield from f
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter(mm.readline, b"")
+
+
+def match_lines(pattern, lines, field=None, fullmatch=False, max_states=None):
+    # For each line, whether the pattern matches it, or with `field`, the
+    # value of that field of the JSON record on the line: a string or a list
+    # of tokens. Lines that aren't such records never match.
+    pattern = compile(pattern, max_states)
+    subjects = []
+    for line in lines:
+        subject = line.decode("utf-8", "replace").rstrip("\r\n")
+        if field is not None:
+            try:
+                subject = json.loads(subject)[field]
+            except (ValueError, LookupError, TypeError):
+                subject = None
+            if not isinstance(subject, (str, list)):
+                subject = None
+        subjects.append(subject)
+    if not fullmatch:
+        return [s is not None and pattern.search(s) is not None for s in subjects]
+    valid = [i for i, s in enumerate(subjects) if s is not None]
+    result = [False] * len(subjects)
+    for i, matched in zip(valid, pattern.match_many([subjects[i] for i in valid])):
+        result[i] = bool(matched)
+    return result
+
+
+def _map_in_order(pool, f, iterable, window):
+    # like pool.map, but with at most `window` tasks in flight; yields
+    # (item, f(item)) so that inputs needn't be kept around by the caller
+    pending = deque()
+    for item in iterable:
+        if len(pending) == window:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+        pending.append((item, pool.submit(f, item)))
+    while pending:
+        done_item, future = pending.popleft()
+        yield done_item, future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tok_regex",
+        description="Print lines (or JSON records) that match a token regex.",
+    )
+    parser.add_argument("pattern", nargs="?", metavar="PATTERN")
+    parser.add_argument("files", nargs="*", metavar="FILE", default=["-"])
+    parser.add_argument(
+        "-c", "--count", action="store_true", help="print the number of matches"
+    )
+    parser.add_argument(
+        "-x", "--fullmatch", action="store_true", help="match whole lines only"
+    )
+    parser.add_argument(
+        "--jsonl-field",
+        metavar="FIELD",
+        help="match the value of FIELD in each JSON line instead of the line",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--max-states",
+        type=int,
+        metavar="N",
+        help="reject patterns whose automaton would have more than N states",
+    )
+    parser.add_argument("--demo", action="store_true", help="run the demo and exit")
+    # options may come after PATTERN and between FILEs, as with grep
+    args = parser.parse_intermixed_args(argv)
+    if args.demo:
+        demo()
+        return 0
+    if args.pattern is None:
+        parser.error("the following arguments are required: PATTERN")
+    try:
+        compile(args.pattern, args.max_states)
+    except (PatternError, BudgetExceeded) as e:
+        parser.error(f"bad pattern: {e}")
+
+    match = partial(
+        match_lines,
+        args.pattern,
+        field=args.jsonl_field,
+        fullmatch=args.fullmatch,
+        max_states=args.max_states,
+    )
+    pool = futures.ProcessPoolExecutor(args.workers) if args.workers > 1 else None
+    out = sys.stdout.buffer
+    total = 0
+    failed = False
+    try:
+        for path in args.files:
+            lines = read_lines(path)
+            batches = iter(lambda: list(itertools.islice(lines, LINE_BATCH)), [])
+            if pool is None:
+                results = ((batch, match(batch)) for batch in batches)
+            else:
+                results = _map_in_order(pool, match, batches, 2 * args.workers)
+            prefix = f"{path}:".encode() if len(args.files) > 1 else b""
+            count = 0
+            try:
+                for batch, matched in results:
+                    for line, ok in zip(batch, matched):
+                        if ok:
+                            count += 1
+                            if not args.count:
+                                out.write(prefix + line.rstrip(b"\n") + b"\n")
+            except OSError as e:
+                if isinstance(e, BrokenPipeError):
+                    raise
+                # like grep: report the file, go on with the others, exit 2
+                out.flush()
+                print(f"tok_regex: {path}: {e.strerror}", file=sys.stderr)
+                failed = True
+                continue
+            if args.count:
+                out.write(prefix + f"{count}\n".encode())
+            total += count
+        out.flush()
+    except BrokenPipeError:
+        # the reader went away, as with | head; drop the rest of the output
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    # grep's convention: 2 on errors, else 0 if anything matched and 1 if not
+    if failed:
+        return 2
+    return 0 if total else 1
+
 
-see(nfa, "aaa")
-see(nfa, "aaaa")
-see(nfa, "bbb")
-see(nfa, "(123) 456-7890")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())